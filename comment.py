@@ -5,20 +5,27 @@ comment.py updates filing and filing_docs tables during import.
 
 """
 
-from lxml import html
+from lxml import html, etree
 import re
+import time
 from utils import *
 import db
+import fetch
+import metrics
 
 # maps FCC comment labels to local field names.
 # a value is either a string, or a sequence consisting of a string and a lambda.
 # The string is used as the column name and the lambda, if any, is used to transform or cleanup
 # the associated data value.
 
+FRACTION_RE = re.compile('\..+$')
+COMMENT_ID_RE = re.compile('id=(\d+)$')
+PAGECOUNT_RE = re.compile('View\s+\((\d+)\)')
+
 FILING_MAP = {
       'Attorney/Author Name:': 'author',
-      'Date Posted:': ['posting_date', lambda(x) : re.sub('\..+$', '', x)],
-      'Date Received:': ['recv_date', lambda(x) : re.sub('\..+$', '', x)],
+      'Date Posted:': ['posting_date', lambda(x) : FRACTION_RE.sub('', x)],
+      'Date Received:': ['recv_date', lambda(x) : FRACTION_RE.sub('', x)],
       'Exparte:': ['exparte', lambda(x) : x.lower() == 'yes'],
       'Lawfirm Name:': 'lawfirm',
       'Name of Filer:': 'applicant',
@@ -26,8 +33,70 @@ FILING_MAP = {
       'Type of Filing:': 'filing_type',
       }
 
-def parse_comment(url):
-    """Parses content of comment url and returns two values; a dict for filing and a list of dicts for associated filing_docs"""
+# Compiled once rather than on every call.
+ITEMS_XPATH = etree.XPath('//div[@class="wwgrp"]/span')
+GROUPS_XPATH = etree.XPath('//div[@class="wwgrp"]')
+LABEL_XPATH = etree.XPath('string(.//label[@class="label"]/text())')
+ANCHORS_XPATH = etree.XPath('.//a')
+
+SECTION_MARKER = 'class="wwgrp"'
+
+CHARSET_RE = re.compile(r'<meta[^>]+charset=["\']?([\w-]+)', re.I)
+
+DIV_TAG_RE = re.compile(r'<(/?)div\b[^>]*?(/?)>', re.I)
+
+def div_end(content, start):
+    """Returns the position just past the </div> that closes the div opened
+       at start, counting the divs nested in it, or -1 if it is not closed"""
+    depth = 0
+    for m in DIV_TAG_RE.finditer(content, start):
+        if m.group(1):
+            depth -= 1
+        elif not m.group(2):
+            depth += 1
+        if depth == 0:
+            return m.end()
+    return -1
+
+def data_section(content):
+    """Returns the part of a comment page that holds the wwgrp data items,
+       wrapped in a minimal document, or None if it cannot be found.
+       The page's declared charset is carried over so that the section is
+       decoded as the whole page would be."""
+
+    first = content.find(SECTION_MARKER)
+    if first < 0:
+        return None
+
+    start = content.rfind('<div', 0, first)
+    last = content.rfind('<div', 0, content.rfind(SECTION_MARKER))
+    if start < 0 or last < 0:
+        return None
+
+    end = div_end(content, last)
+    if end < 0:
+        return None
+
+    head = ''
+    m = CHARSET_RE.search(content, 0, start)
+    if m:
+        head = '<head><meta http-equiv="Content-Type" content="text/html; charset=%s"></head>' % (m.group(1),)
+
+    return '<html>' + head + '<body>' + content[start:end] + '</body></html>'
+
+def comment_number(url):
+    """Returns the fcc_num of a comment or document url, or None"""
+    m = COMMENT_ID_RE.search(url.strip())
+    if m:
+        return m.group(1)
+    return None
+
+def parse_comment(url, content=None, section_only=True):
+    """Parses content of comment url and returns two values; a dict for filing and a list of dicts for associated filing_docs.
+       The page is fetched unless its content is provided.
+       With section_only, only the data section of the page is parsed, falling
+       back to the whole page if the section cannot be found or does not hold
+       every data group of the page."""
     
     comment = {}
     documents = []
@@ -36,14 +105,26 @@ def parse_comment(url):
 
     try:
         try:
-            comment['fcc_num'] = re.search('id=(\d+)$', url).group(1)
+            comment['fcc_num'] = COMMENT_ID_RE.search(url).group(1)
         except:
             warn("comment url does not match expected ...id=XXX format", url)
 
-        page = html.parse(url)
+        if content is None:
+            content = fetch.get(url)
 
         # Grab all items in data section
-        items = page.xpath('//div[@class="wwgrp"]/span')
+        items = []
+        if section_only:
+            section = data_section(content)
+            if section:
+                tree = html.document_fromstring(section)
+                # markup the section does not hold together loses groups
+                if len(GROUPS_XPATH(tree)) == section.count(SECTION_MARKER):
+                    items = ITEMS_XPATH(tree)
+
+        # or, failing that, in the whole page
+        if not items:
+            items = ITEMS_XPATH(html.document_fromstring(content))
     except Exception as e:
         warn(e, 'url: ' + url)
         return data
@@ -52,12 +133,12 @@ def parse_comment(url):
     for label, content in zip(items[::2], items[1::2]):
         # verify that we are in the right spot
         try:
-            label_text = label.xpath('string(.//label[@class="label"]/text())').strip()
+            label_text = LABEL_XPATH(label).strip()
         except Exception as e:
             warn("cannot parse label: %s: %s" % (label, e))
             continue
 
-        node = content.xpath('.//a')
+        node = ANCHORS_XPATH(content)
 
         if node: # A list of urls...
             if label_text == 'Proceeding Number:': # Ignore link back to proceeding
@@ -67,11 +148,11 @@ def parse_comment(url):
                     url = hostify_url(clean_url(anchor.get('href')))
                     doc = { 'url': url }
 
-                    m = re.search('id=(\d+)$', url)
+                    m = COMMENT_ID_RE.search(url)
                     if m:
                         doc['fcc_num'] = m.group(1)
 
-                    m = re.search('View\s+\((\d+)\)', anchor.text)
+                    m = PAGECOUNT_RE.search(anchor.text or '')
                     if m:
                         doc['pagecount'] = m.group(1)
                     
@@ -91,15 +172,16 @@ def parse_comment(url):
     return data
 
 
-def import_comment(proceeding_id, url):
+def import_comment(proceeding_id, url, content=None):
     """
     The contents of url is imported into the filings table and the filing_docs table.
     If the record is not new,  the insert fails with a duplicate error, which causes the attempt to be abandonded.
     Otherwise the associated documents, if any, are also added.
+    content, if given, is the already fetched page.
     """
 
     try:
-        filing, documents = parse_comment(url)
+        filing, documents = parse_comment(url, content)
     except Exception as e:
         warn("Error %s on url: %s" % (e, url))
         return
@@ -130,8 +212,145 @@ def import_comment(proceeding_id, url):
 
         conn.commit()
 
+def group_by_columns(records):
+    """Groups dicts by their set of keys. Returns a dict of column tuple to row tuples"""
+    groups = {}
+    for record in records:
+        columns = tuple(sorted(record.keys()))
+        groups.setdefault(columns, []).append(tuple(record[c] for c in columns))
+    return groups
+
+class CommentBatch(object):
+    """
+    Accumulates parsed comments and writes them in bulk.
+    Filings are inserted with multi-row INSERT ... ON CONFLICT DO NOTHING statements,
+    so existing records are skipped without errors or rollbacks, and the documents
+    of the new filings are linked and inserted in the same transaction.
+    If a batch fails, its comments are imported one at a time instead.
+    Comments without an fcc_num, whose documents the batch has no way to link
+    to their filing, are imported one at a time straight away.
+    """
+
+    def __init__(self, size=100):
+        self.size = size
+        self.items = []
+
+    def add(self, proceeding_id, url, content=None):
+        """Parses the comment at url and queues it for writing"""
+        try:
+            with metrics.timer('comment_parse_seconds'):
+                filing, documents = parse_comment(url, content)
+        except Exception as e:
+            metrics.inc('comment_parse_errors_total')
+            warn("Error %s on url: %s" % (e, url))
+            return
+
+        metrics.inc('comments_parsed_total')
+
+        if not filing.get('fcc_num'):
+            metrics.inc('comments_without_number_total')
+            warn("comment has no fcc_num, importing it on its own: %s" % (url,))
+            import_comment(proceeding_id, url, content)
+            return
+
+        filing.update(proceeding_id=proceeding_id)
+        self.items.append((url, content, filing, documents))
+
+        if len(self.items) >= self.size:
+            self.flush()
+
+    def flush(self):
+        """Writes queued comments and commits them"""
+        items, self.items = self.items, []
+        if not items:
+            return
+
+        conn = db.connection()
+        cur = conn.cursor()
+        start = time.time()
+
+        try:
+            filing_ids = {}
+            for columns, rows in group_by_columns(filing for _, _, filing, _ in items).iteritems():
+                for filing_id, fcc_num in db.insert_many(cur, 'filings', columns, rows,
+                                                         suffix=' ON CONFLICT DO NOTHING RETURNING id, fcc_num'):
+                    filing_ids[str(fcc_num)] = filing_id
+
+            inserted = len(filing_ids)
+            docs = []
+            for _, _, filing, documents in items:
+                filing_id = filing_ids.pop(str(filing['fcc_num']), None)
+                if filing_id is None: # existing filing or repeated in batch
+                    continue
+                for doc in documents:
+                    doc.update(filing_id=filing_id)
+                    docs.append(doc)
+
+            for columns, rows in group_by_columns(docs).iteritems():
+                db.insert_many(cur, 'filing_docs', columns, rows, suffix=' ON CONFLICT DO NOTHING')
+
+            conn.commit()
+
+            metrics.observe('comment_db_insert_seconds', time.time() - start)
+            metrics.inc('comments_inserted_total', inserted)
+            metrics.inc('filing_docs_inserted_total', len(docs))
+        except Exception as e:
+            conn.rollback()
+            warn("Error %s while importing batch of %d comments, importing one at a time" % (e, len(items)))
+            for url, content, filing, documents in items:
+                import_comment(filing['proceeding_id'], url, content)
+
+def bench(corpus, rounds=3):
+    """Parses every saved comment page in the corpus directory, rounds times,
+       in both full page and data section modes, and reports throughput and
+       peak memory. Also checks that both modes extract the same fields."""
+
+    import os
+    import os.path as path
+    import resource
+    import time
+
+    pages = []
+    for name in sorted(os.listdir(corpus)):
+        with open(path.join(corpus, name)) as f:
+            pages.append(("%s/ecfs/comment/view?id=%s" % (HOST, path.splitext(name)[0]), f.read()))
+
+    if not pages:
+        print "no pages in", corpus
+        return
+
+    mismatches = 0
+    for url, content in pages:
+        section = parse_comment(url, content, True)
+        full = parse_comment(url, content, False)
+        if section != full:
+            mismatches += 1
+            print "modes differ for", url
+            print "  section:", section
+            print "  full:   ", full
+    print "%d of %d pages parse differently in section mode" % (mismatches, len(pages))
+
+    # section mode first, since peak rss is a high-water mark for the process
+    for section_only in (True, False):
+        start = time.time()
+        for i in range(rounds):
+            for url, content in pages:
+                parse_comment(url, content, section_only)
+        elapsed = time.time() - start
+
+        print "%-8s %d pages x %d rounds: %.1f pages/sec, peak rss %d KB" % (
+            'section' if section_only else 'full', len(pages), rounds,
+            len(pages) * rounds / elapsed,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
 if  __name__ == "__main__":
     import pprint
     import sys
+
+    # python comment.py bench corpus-directory [rounds]
+    if sys.argv[1] == 'bench':
+        bench(sys.argv[2], *[int(x) for x in sys.argv[3:4]])
+        sys.exit(0)
+
     pp = pprint.PrettyPrinter(indent=4)
     pp.pprint(parse_comment(sys.argv[2]))
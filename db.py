@@ -1,22 +1,49 @@
 #/bin/env python
-""" Database functions """
+""" Database functions
+
+Connections come from a pool shared by all threads. Each thread checks out
+its own connection the first time it calls connection() and keeps it until
+it calls release(). Connections are checked before they are handed out and
+replaced when they have been lost, unless that would hide the loss of a
+transaction in progress.
+"""
 
 
 import os
 import os.path as path
 import sys
 import re
+import threading
+import time
 import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
 import dictconfig
 
 
-# database connection. Will be set when necessary.
-CONNECTION = None
+# connection pool. Will be set when necessary.
+POOL = None
+POOL_LOCK = threading.Lock()
+
+# connection arguments, parsed once.
+ARGS = None
+
+# per thread connection
+LOCAL = threading.local()
+
+# idle connections are checked if they have not been used for this many seconds.
+HEALTH_CHECK_INTERVAL = 30
+
+# errors that indicate a lost connection
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
 
 def connection_args():
     """Reads config/database.yml returns the database configuration
     matching RAILS_ENV value"""
 
+    global ARGS
+    if ARGS is not None:
+        return ARGS
 
     app_config = dictconfig.parse()
 
@@ -52,16 +79,92 @@ def connection_args():
                         pass 
 
 
-    return ' '.join(data)
+    ARGS = ' '.join(data)
+    return ARGS
+
+def pool():
+    """Returns the connection pool, creating it if necessary.
+    Its size is set by database.pool-min and database.pool-max in config."""
+    global POOL
+    with POOL_LOCK:
+        if not POOL:
+            app_config = dictconfig.parse()
+            POOL = psycopg2.pool.ThreadedConnectionPool(
+                int(app_config.get('database.pool-min', 1)),
+                int(app_config.get('database.pool-max', 16)),
+                connection_args())
+    return POOL
+
+def healthy(conn):
+    """Tells whether conn is still usable. Idle connections that have not
+    been used recently are checked with a trivial query."""
+
+    if conn.closed:
+        return False
+
+    status = conn.get_transaction_status()
+    if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+        return False
+
+    if status == psycopg2.extensions.TRANSACTION_STATUS_IDLE and \
+       time.time() - getattr(LOCAL, 'checked', 0) > HEALTH_CHECK_INTERVAL:
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+        except CONNECTION_ERRORS:
+            return False
+
+    LOCAL.checked = time.time()
+    return True
 
 def connection():
-    """Stores and returns a handle to the database"""
-    global CONNECTION
-    #TODO -- check for lost connection and retry...
-    if not CONNECTION:
-        CONNECTION = psycopg2.connect(connection_args())
-
-    return CONNECTION
+    """Returns this thread's database connection, checking one out of the
+    pool if necessary. A lost connection is replaced, but if a transaction
+    was in progress on it, an OperationalError is raised instead so that the
+    caller knows the work done in that transaction is gone. The next call
+    returns a new connection."""
+
+    conn = getattr(LOCAL, 'connection', None)
+
+    if conn is not None and not healthy(conn):
+        in_transaction = conn.status != psycopg2.extensions.STATUS_READY
+        discard()
+        if in_transaction:
+            raise psycopg2.OperationalError("database connection lost during a transaction")
+        conn = None
+
+    while conn is None:
+        conn = pool().getconn()
+        LOCAL.connection = conn
+        LOCAL.checked = 0
+        if not healthy(conn):
+            discard()
+            conn = None
+
+    return conn
+
+def release():
+    """Returns this thread's connection to the pool"""
+    conn = getattr(LOCAL, 'connection', None)
+    if conn is not None:
+        LOCAL.connection = None
+        try:
+            conn.rollback()
+        except CONNECTION_ERRORS:
+            pass
+        pool().putconn(conn, close=bool(conn.closed))
+
+def discard():
+    """Drops this thread's connection, which has been lost"""
+    conn = getattr(LOCAL, 'connection', None)
+    if conn is not None:
+        LOCAL.connection = None
+        try:
+            pool().putconn(conn, close=True)
+        except Exception:
+            pass
 
 def cursor():
     """..."""
@@ -77,5 +180,26 @@ def dict_to_sql_insert(tablename, data):
 
     return [query, values]
 
+def insert_many(cur, tablename, columns, rows, template=None, page_size=500, suffix=''):
+    """inserts rows, a sequence of tuples matching columns, into tablename
+    using multi-row INSERT statements of up to page_size rows each.
+    template is the SQL for a single row, '(%s, %s, ...)' by default,
+    and may wrap values in expressions. suffix is appended to each statement,
+    for ON CONFLICT or RETURNING clauses. Returns the rows returned, if any."""
+
+    if template is None:
+        template = '(%s)' % (', '.join(['%s'] * len(columns)),)
+
+    query = "INSERT INTO %s (%s) VALUES " % (tablename, ', '.join(columns))
+
+    results = []
+    for start in range(0, len(rows), page_size):
+        values = ', '.join([cur.mogrify(template, row) for row in rows[start:start + page_size]])
+        cur.execute(query + values + suffix)
+        if cur.description:
+            results.extend(cur.fetchall())
+
+    return results
+
 if __name__ == "__main__":
     print connection_args()
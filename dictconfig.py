@@ -22,6 +22,10 @@ usage:
   # be more explicit
   config = configdict.parsepath("..../config.ini")
 
+  # read single settings of a section, with defaults
+  setting = configdict.section('fetch')
+  timeout = setting('timeout', 60)
+
 """
 
 import io
@@ -59,6 +63,23 @@ def parsestr(configstr):
   """parse parses a string into a dict"""
   return parseconfig(configstr, 'string')
 
+SETTINGS = None
+
+def setting(section, name, default):
+  """returns option name of section from config.ini, parsed once,
+     or default if it is not set or the file cannot be read"""
+  global SETTINGS
+  if SETTINGS is None:
+    try:
+      SETTINGS = parse()
+    except Exception:
+      SETTINGS = {}
+  return SETTINGS.get("%s.%s" % (section, name), default)
+
+def section(section):
+  """returns a setting(name, default) function for the options of section"""
+  return lambda name, default: setting(section, name, default)
+
 if __name__ == "__main__":
   import sys
   print parsepath(sys.argv[1])
@@ -0,0 +1,296 @@
+#!/bin/env python
+
+"""
+extraction.py is an in-process replacement for the extract script.
+
+It produces the same workdir layout:
+
+  jpeg/page-N.jpg  page images
+  text/page-N.txt  page text
+
+but, instead of starting pdftoppm, unpaper and tesseract for every page, it
+keeps a pool of worker processes, one per core, each holding a warm OCR
+engine. The embedded text layer of all pages is read by a single pdftotext
+run, and pages with a usable text layer skip OCR altogether. The other pages
+are handed to the pool in runs of consecutive pages, each of which is
+rasterized by one pdftoppm and cleaned by one unpaper, in scratch space.
+
+The warm engine requires the tesserocr and PIL modules. Without them, each page
+is piped through the tesseract command instead, which still avoids the
+intermediate files but not the model loading.
+
+The pool is forked when it is first used, and forking a process that runs
+other threads can leave the children stuck on locks held at the time, so
+a threaded caller must call get_pool before it starts any threads, as
+task.extract does.
+
+usage:
+
+  import extraction
+
+  stats = extraction.extract(url, workdir)
+
+or, from the command line, to see where the time goes:
+
+  python extraction.py url-or-pdf-file [workdir]
+
+"""
+
+import os
+import os.path as path
+import subprocess
+import multiprocessing
+import threading
+import tempfile
+import shutil
+import time
+import urllib2
+from io import BytesIO
+
+try:
+    import tesserocr
+    from PIL import Image
+except ImportError:
+    tesserocr = None
+
+from utils import *
+import metrics
+
+# Pages whose text layer has fewer letters and digits than this are OCR'd.
+MIN_TEXT_CHARS = int(os.getenv('EXTRACT_MIN_TEXT_CHARS', 100))
+
+# Pages are OCR'd in runs of up to this many consecutive pages.
+OCR_RUN_PAGES = int(os.getenv('EXTRACT_OCR_RUN_PAGES', 8))
+
+# Use memory backed scratch space for rasterized pages when available.
+SCRATCH_DIR = '/dev/shm' if path.isdir('/dev/shm') else None
+
+RASTER_ARGS = ['-mono', '-r', '300', '-aa', 'no', '-aaVector', 'no']
+
+# OCR engine owned by each pool process
+ENGINE = None
+
+POOL = None
+POOL_LOCK = threading.Lock()
+
+def _init_engine():
+    global ENGINE
+    if tesserocr:
+        ENGINE = tesserocr.PyTessBaseAPI(lang='eng')
+
+def get_pool():
+    """Returns the process wide pool of OCR processes, creating it if necessary"""
+    global POOL
+    with POOL_LOCK:
+        if not POOL:
+            if threading.active_count() > 1:
+                warn("extraction: starting OCR pool in a threaded process")
+            POOL = multiprocessing.Pool(initializer=_init_engine)
+    return POOL
+
+def run(args, data=None):
+    """runs command with args, feeding it data, and returns its output"""
+    proc = subprocess.Popen(args, stdin=subprocess.PIPE if data is not None else None,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = proc.communicate(data)
+    if proc.returncode != 0:
+        raise Exception("%s failed with status %d: %s" % (args[0], proc.returncode, err.strip()))
+    return out
+
+def page_count(pdf):
+    for line in run(['pdfinfo', pdf]).splitlines():
+        if line.startswith('Pages:'):
+            return int(line.split()[1])
+    raise Exception("cannot find page count for " + pdf)
+
+def page_name(number, width):
+    """returns padded page name, matching pdftoppm and pdftocairo output"""
+    return "page-%0*d" % (width, number)
+
+def usable(txt):
+    """Tells whether the text layer of a page has enough text to skip OCR"""
+    return sum(1 for c in txt if c.isalnum()) >= MIN_TEXT_CHARS
+
+def text_layer(pdf, number):
+    """Returns embedded text of page number if it is usable, otherwise None"""
+    try:
+        txt = run(['pdftotext', '-q', '-f', str(number), '-l', str(number),
+                   '-layout', '-enc', 'UTF-8', pdf, '-'])
+    except Exception:
+        return None
+
+    return txt if usable(txt) else None
+
+def text_layers(pdf, first_page, last_page):
+    """Returns a dict of page number to the embedded text of each page from
+       first_page to last_page, or None for pages whose text is not usable.
+       pdftotext runs once for the whole range and ends every page with a form
+       feed. If its output cannot be split into pages, each page is read on
+       its own instead."""
+    try:
+        txt = run(['pdftotext', '-q', '-f', str(first_page), '-l', str(last_page),
+                   '-layout', '-enc', 'UTF-8', pdf, '-'])
+    except Exception:
+        txt = ''
+
+    pages = txt.split('\f')[:-1]
+    numbers = range(first_page, last_page + 1)
+    if len(pages) != len(numbers):
+        return dict((number, text_layer(pdf, number)) for number in numbers)
+
+    return dict((number, page + '\f' if usable(page) else None)
+                for number, page in zip(numbers, pages))
+
+def ocr_runs(numbers, size):
+    """Splits sorted page numbers into runs of at most size consecutive pages.
+       Returns a list of (first page, last page) pairs."""
+    runs = []
+    for number in numbers:
+        if runs and runs[-1][1] == number - 1 and number - runs[-1][0] < size:
+            runs[-1][1] = number
+        else:
+            runs.append([number, number])
+    return [tuple(r) for r in runs]
+
+def ocr(image):
+    """Returns text of pbm image data"""
+    if ENGINE:
+        ENGINE.SetImage(Image.open(BytesIO(image)))
+        return ENGINE.GetUTF8Text().encode('utf-8')
+    return run(['tesseract', 'stdin', 'stdout', '-l', 'eng'], image)
+
+def ocr_pages(job):
+    """Pool task. Rasterizes, cleans and OCRs a run of consecutive pages.
+       Returns a list of (page number, text, timings) tuples, where timings is
+       a dict of the time spent on the page in each step. Rasterizing and
+       cleaning are done for the whole run, so their times are split evenly
+       between its pages."""
+    pdf, first_page, last_page = job
+    count = last_page - first_page + 1
+
+    scratch = tempfile.mkdtemp(prefix='ocr-', dir=SCRATCH_DIR)
+    try:
+        start = time.time()
+        run(['pdftoppm', '-f', str(first_page), '-l', str(last_page)] + RASTER_ARGS +
+            [pdf, path.join(scratch, 'raster')])
+        # pdftoppm pads page numbers; unpaper wants them plain.
+        for name in os.listdir(scratch):
+            number = int(name.rsplit('-', 1)[1].split('.')[0])
+            os.rename(path.join(scratch, name), path.join(scratch, 'in-%d.pbm' % (number,)))
+        rasterize = (time.time() - start) / count
+
+        start = time.time()
+        run(['unpaper', '-q', '--start-sheet', str(first_page), '--end-sheet', str(last_page),
+             path.join(scratch, 'in-%d.pbm'), path.join(scratch, 'out-%d.pbm')])
+        cleanup = (time.time() - start) / count
+
+        results = []
+        for number in range(first_page, last_page + 1):
+            with open(path.join(scratch, 'out-%d.pbm' % (number,)), 'rb') as f:
+                image = f.read()
+
+            start = time.time()
+            txt = ocr(image)
+            results.append((number, txt, {'rasterize': rasterize, 'cleanup': cleanup,
+                                          'ocr': time.time() - start}))
+        return results
+    finally:
+        shutil.rmtree(scratch, True)
+
+def download(url, pdf):
+    src = urllib2.urlopen(url)
+    try:
+        with open(pdf, 'wb') as f:
+            shutil.copyfileobj(src, f)
+    finally:
+        src.close()
+
+def extract(url, workdir, pdf=None, first_page=None, last_page=None):
+    """Extracts page images and text of the pdf at url into workdir.
+       If first_page or last_page are given, only that range of pages is extracted.
+       Returns a dict of statistics, including the total time spent in
+       each OCR step."""
+
+    if not pdf:
+        pdf = path.join(workdir, url.split('=')[-1] + '.pdf')
+
+    stats = {'download': 0.0, 'images': 0.0, 'text-layer': 0.0,
+             'rasterize': 0.0, 'cleanup': 0.0, 'ocr': 0.0,
+             'pages': 0, 'ocr-pages': 0}
+
+    start = time.time()
+    if not path.exists(pdf):
+        download(url, pdf)
+    stats['download'] = time.time() - start
+
+    textdir = path.join(workdir, 'text')
+    jpegdir = path.join(workdir, 'jpeg')
+    for d in (textdir, jpegdir):
+        if not path.isdir(d):
+            os.makedirs(d)
+
+    npages = page_count(pdf)
+    width = len(str(npages))
+
+    first_page = max(int(first_page or 1), 1)
+    last_page = min(int(last_page or npages), npages)
+    stats['pages'] = max(last_page - first_page + 1, 0)
+
+    # page images are rendered in the background while the text is extracted.
+    images_start = time.time()
+    images = subprocess.Popen(['pdftocairo', '-f', str(first_page), '-l', str(last_page),
+                               '-jpeg', pdf, path.join(jpegdir, 'page')])
+
+    start = time.time()
+    todo = []
+    layers = text_layers(pdf, first_page, last_page) if stats['pages'] else {}
+    for number in sorted(layers):
+        txt = layers[number]
+        if txt is None:
+            todo.append(number)
+        else:
+            with open(path.join(textdir, page_name(number, width) + '.txt'), 'wb') as f:
+                f.write(txt)
+    stats['text-layer'] = time.time() - start
+
+    stats['ocr-pages'] = len(todo)
+    if todo:
+        # short runs for small documents, so that every core gets some
+        size = min(OCR_RUN_PAGES, max(len(todo) / multiprocessing.cpu_count(), 1))
+        jobs = [(pdf, first, last) for first, last in ocr_runs(todo, size)]
+        for results in get_pool().imap_unordered(ocr_pages, jobs):
+            for number, txt, timings in results:
+                with open(path.join(textdir, page_name(number, width) + '.txt'), 'wb') as f:
+                    f.write(txt)
+
+                for name, value in timings.iteritems():
+                    stats[name] += value
+                    metrics.observe('extract_%s_seconds' % (name,), value)
+
+    if images.wait() != 0:
+        raise Exception("pdftocairo failed for " + pdf)
+    stats['images'] = time.time() - images_start
+
+    metrics.observe('extract_images_seconds', stats['images'])
+    metrics.observe('extract_text_layer_seconds', stats['text-layer'])
+    metrics.inc('extract_ocr_pages_total', stats['ocr-pages'])
+
+    return stats
+
+if __name__ == "__main__":
+    import sys
+    import pprint
+
+    source = sys.argv[1]
+    workdir = sys.argv[2] if len(sys.argv) > 2 else tempfile.mkdtemp(prefix='extraction-')
+
+    if path.exists(source):
+        stats = extract(None, workdir, path.abspath(source))
+    else:
+        stats = extract(source, workdir)
+
+    if stats['ocr-pages']:
+        for name in ('rasterize', 'cleanup', 'ocr'):
+            stats[name + '-per-page'] = stats[name] / stats['ocr-pages']
+
+    pprint.PrettyPrinter(indent=4).pprint(stats)
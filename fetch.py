@@ -0,0 +1,223 @@
+#!/bin/env python
+
+"""
+fetch.py retrieves FCC pages over persistent HTTP connections.
+
+Each thread keeps one keep-alive connection per host, and requests to a host
+are spaced out so that, across all threads, no more than fetch.rate requests
+per second are made to it. fetch_all runs a bounded number of requests
+concurrently and hands the responses back to the caller, which is free to
+parse and store them while the next pages are on their way.
+
+Responses are cached on disk (see httpcache.py) so that re-runs and dry runs
+are mostly served locally.
+
+Settings, in the [fetch] section of the config file:
+
+  concurrency   number of requests in flight (default 4)
+  rate          requests per second per host (default 2)
+  timeout       socket timeout in seconds (default 60)
+  cache-dir     cache directory (default cache/http in the application
+                directory), or none to disable the cache
+  cache-size    cache size cap in megabytes (default 1024)
+  ttl-comment   seconds before a comment page is revalidated (default 30 days)
+  ttl-search    seconds before a search result page is revalidated (default 1 hour)
+  ttl-rss       seconds before an rss feed is revalidated (default 15 minutes)
+
+usage:
+
+  import fetch
+
+  content = fetch.get(url)
+
+  for url, content, error in fetch.fetch_all(urls):
+      ...
+
+"""
+
+import httplib
+import urlparse
+import threading
+import Queue
+import time
+import os.path as path
+import sys
+
+from utils import *
+import dictconfig
+import httpcache
+import metrics
+
+# per thread connections, keyed by (scheme, host)
+LOCAL = threading.local()
+
+MAX_REDIRECTS = 5
+
+setting = dictconfig.section('fetch')
+
+class RateLimiter(object):
+    """Spaces out requests to each host by a minimum interval"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, host):
+        with self.lock:
+            now = time.time()
+            slot = max(self.next_slot.get(host, now), now)
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+LIMITER = None
+LIMITER_LOCK = threading.Lock()
+
+def limiter():
+    global LIMITER
+    with LIMITER_LOCK:
+        if not LIMITER:
+            LIMITER = RateLimiter(float(setting('rate', 2)))
+    return LIMITER
+
+def connection(scheme, host):
+    """Returns this thread's connection to host"""
+    if not hasattr(LOCAL, 'connections'):
+        LOCAL.connections = {}
+
+    conn = LOCAL.connections.get((scheme, host))
+    if not conn:
+        cls = httplib.HTTPSConnection if scheme == 'https' else httplib.HTTPConnection
+        conn = cls(host, timeout=float(setting('timeout', 60)))
+        LOCAL.connections[(scheme, host)] = conn
+    return conn
+
+def request(url, headers=None):
+    """Makes a GET request for url, following redirects.
+       Returns the response and its body."""
+
+    for i in range(MAX_REDIRECTS + 1):
+        parts = urlparse.urlsplit(url)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+
+        limiter().wait(parts.netloc)
+
+        # a kept-alive connection may have been closed by the server, so retry once.
+        for attempt in range(2):
+            conn = connection(parts.scheme, parts.netloc)
+            try:
+                with metrics.timer('fetch_request_seconds'):
+                    conn.request('GET', target, headers=headers or {})
+                    response = conn.getresponse()
+                    body = response.read()
+                metrics.inc('fetch_requests_total')
+                metrics.inc('fetch_bytes_total', len(body))
+                break
+            except (httplib.HTTPException, IOError):
+                conn.close()
+                LOCAL.connections.pop((parts.scheme, parts.netloc), None)
+                if attempt:
+                    raise
+
+        if response.status in (301, 302, 303, 307) and response.getheader('location'):
+            url = urlparse.urljoin(url, response.getheader('location'))
+            continue
+
+        return response, body
+
+    raise Exception("too many redirects: " + url)
+
+CACHE = None
+CACHE_LOCK = threading.Lock()
+
+def cache():
+    """Returns the response cache or None if it is disabled"""
+    global CACHE
+    with CACHE_LOCK:
+        if CACHE is None:
+            directory = setting('cache-dir', path.join(path.dirname(sys.argv[0]), 'cache/http'))
+            if directory and directory != 'none':
+                ttls = [('/ecfs/comment/view', int(setting('ttl-comment', 30 * 86400))),
+                        ('/ecfs/comment_search/rss', int(setting('ttl-rss', 15 * 60))),
+                        ('/ecfs/comment_search/', int(setting('ttl-search', 3600)))]
+                CACHE = httpcache.HTTPCache(directory, int(setting('cache-size', 1024)) << 20,
+                                            ttls, int(setting('ttl-search', 3600)))
+            else:
+                CACHE = False
+    return CACHE
+
+def get(url):
+    """Returns the content of url"""
+    with metrics.timer('fetch_seconds'):
+        if cache():
+            return cache().get(url, request)
+
+        response, body = request(url)
+        if response.status != 200:
+            raise Exception("HTTP %d fetching %s" % (response.status, url))
+        return body
+
+def fetch_all(urls, concurrency=None, getter=None):
+    """A generator that fetches urls, an iterable, with up to concurrency
+       requests in flight and yields (url, content, error) tuples in
+       completion order. error is None on success. If iterating over urls
+       raises, the exception is raised again once the urls produced before
+       it have been yielded."""
+
+    if concurrency is None:
+        concurrency = int(setting('concurrency', 4))
+    if getter is None:
+        getter = get
+
+    todo = Queue.Queue(maxsize=concurrency)
+    done = Queue.Queue(maxsize=concurrency * 2)
+
+    def worker():
+        while True:
+            url = todo.get()
+            if url is None:
+                done.put(None)
+                break
+            try:
+                done.put((url, getter(url), None))
+            except Exception as e:
+                metrics.inc('fetch_errors_total')
+                done.put((url, None, e))
+
+    # exc_info of an error raised by urls, for the consumer
+    failed = []
+
+    def feeder():
+        try:
+            for url in urls:
+                todo.put(url)
+        except Exception:
+            failed.extend(sys.exc_info())
+        finally:
+            for i in range(concurrency):
+                todo.put(None)
+
+    threads = [threading.Thread(target=feeder)]
+    threads.extend(threading.Thread(target=worker) for i in range(concurrency))
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    running = concurrency
+    while running:
+        item = done.get()
+        if item is None:
+            running -= 1
+        else:
+            yield item
+
+    if failed:
+        raise failed[0], failed[1], failed[2]
+
+if __name__ == "__main__":
+    import sys
+    for url, content, error in fetch_all(sys.argv[1:]):
+        print url, error or len(content)
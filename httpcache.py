@@ -0,0 +1,160 @@
+#!/bin/env python
+
+"""
+httpcache.py keeps fetched pages on disk so re-runs are served locally.
+
+Each response is stored as a pair of files named by the sha1 of its url:
+the body and a JSON record of the url, validators and fetch time. An entry
+younger than the TTL for its kind of url is returned without a request.
+Older entries are revalidated with If-None-Match and If-Modified-Since, and a
+304 response refreshes the entry. Once the bodies exceed max_size bytes, the
+least recently used entries are evicted.
+
+usage:
+
+  import httpcache
+
+  cache = httpcache.HTTPCache('cache/http', 1 << 30, [('/ecfs/comment/view', 30 * 86400)], 3600)
+
+  body = cache.get(url, request)
+
+where request(url, headers) returns an httplib response and its body.
+
+"""
+
+import os
+import os.path as path
+import hashlib
+import json
+import threading
+import time
+
+class HTTPCache(object):
+
+    def __init__(self, directory, max_size, ttls, default_ttl):
+        """ttls is a list of (url substring, seconds) pairs, checked in order"""
+        self.directory = directory
+        self.max_size = max_size
+        self.ttls = ttls
+        self.default_ttl = default_ttl
+        self.lock = threading.Lock()
+        self.size = None
+
+        if not path.isdir(directory):
+            os.makedirs(directory)
+
+    def ttl(self, url):
+        for pattern, seconds in self.ttls:
+            if pattern in url:
+                return seconds
+        return self.default_ttl
+
+    def filenames(self, url):
+        name = path.join(self.directory, hashlib.sha1(url).hexdigest())
+        return name + '.body', name + '.json'
+
+    def load(self, url):
+        body_file, meta_file = self.filenames(url)
+        try:
+            with open(meta_file) as f:
+                meta = json.load(f)
+            with open(body_file, 'rb') as f:
+                body = f.read()
+        except (IOError, ValueError):
+            return None, None
+
+        if meta.get('url') != url:
+            return None, None
+
+        return meta, body
+
+    def store(self, url, meta, body):
+        body_file, meta_file = self.filenames(url)
+
+        old_size = path.getsize(body_file) if path.exists(body_file) else 0
+
+        for filename, data in ((body_file, body), (meta_file, json.dumps(meta))):
+            tmp = '%s.%d.%s.tmp' % (filename, os.getpid(), threading.current_thread().ident)
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, filename)
+
+        with self.lock:
+            if self.size is not None:
+                self.size += len(body) - old_size
+
+        self.evict()
+
+    def touch(self, url):
+        """Marks entry as recently used"""
+        try:
+            os.utime(self.filenames(url)[0], None)
+        except OSError:
+            pass
+
+    def get(self, url, request):
+        """Returns the body of url from the cache, revalidating or fetching it
+           with request as needed"""
+
+        meta, body = self.load(url)
+        now = time.time()
+
+        if meta and now - meta['fetched'] < self.ttl(url):
+            self.touch(url)
+            return body
+
+        headers = {}
+        if meta:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        response, content = request(url, headers)
+
+        if response.status == 304 and meta:
+            meta['fetched'] = now
+            self.store(url, meta, body)
+            return body
+
+        if response.status != 200:
+            raise Exception("HTTP %d fetching %s" % (response.status, url))
+
+        self.store(url, {'url': url, 'fetched': now,
+                         'etag': response.getheader('etag'),
+                         'last_modified': response.getheader('last-modified')}, content)
+        return content
+
+    def evict(self):
+        """Removes least recently used entries until the cache fits in max_size"""
+        with self.lock:
+            if self.size is None:
+                self.size = sum(path.getsize(path.join(self.directory, name))
+                                for name in os.listdir(self.directory) if name.endswith('.body'))
+
+            if self.size <= self.max_size:
+                return
+
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith('.body'):
+                    filename = path.join(self.directory, name)
+                    try:
+                        st = os.stat(filename)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, filename))
+
+            entries.sort()
+
+            # evict down to 90% so that eviction does not run on every store.
+            target = self.max_size * 0.9
+            for mtime, size, filename in entries:
+                if self.size <= target:
+                    break
+                for victim in (filename, filename[:-len('.body')] + '.json'):
+                    try:
+                        os.remove(victim)
+                    except OSError:
+                        pass
+                self.size -= size
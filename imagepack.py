@@ -0,0 +1,110 @@
+#!/bin/env python
+
+"""
+imagepack.py stores all the page images of a document in a single object.
+
+A pack consists of a short header followed by the images, back to back:
+
+  'FCCI'           magic
+  version          1 byte
+  index length     4 bytes, big endian
+  index            JSON: {"pages": [[number, offset, size], ...]}
+  images
+
+Offsets are from the start of the pack, so a viewer can fetch the first
+HEADER_FETCH_SIZE bytes, read the index, then fetch a single page with a ranged
+GET.
+
+usage:
+
+  import imagepack
+
+  index = imagepack.pack({1: 'jpeg/page-1.jpg', 2: 'jpeg/page-2.jpg'}, 'pages.pack')
+
+  jpeg = imagepack.read_page(key, 2)
+
+"""
+
+import json
+import struct
+
+MAGIC = 'FCCI'
+VERSION = 1
+PREFIX = struct.Struct('>4sBI')
+
+# Enough to hold the index of all but the largest documents.
+HEADER_FETCH_SIZE = 64 * 1024
+
+def pack(images, dest):
+    """Writes a pack of images, a dict of page number to filename, to the file dest.
+       Returns the index as a list of [number, offset, size] entries."""
+
+    sizes = []
+    for number in sorted(images):
+        with open(images[number], 'rb') as f:
+            f.seek(0, 2)
+            sizes.append((number, f.tell()))
+
+    # offsets depend on the length of the index, which depends on the offsets.
+    # Iterate until the encoded length settles.
+    header_len = 0
+    while True:
+        offset = PREFIX.size + header_len
+        index = []
+        for number, size in sizes:
+            index.append([number, offset, size])
+            offset += size
+
+        header = json.dumps({'pages': index}, separators=(',', ':'))
+        if len(header) == header_len:
+            break
+        header_len = len(header)
+
+    with open(dest, 'wb') as out:
+        out.write(PREFIX.pack(MAGIC, VERSION, len(header)))
+        out.write(header)
+        for number in sorted(images):
+            with open(images[number], 'rb') as f:
+                while True:
+                    chunk = f.read(1 << 16)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+
+    return index
+
+def parse_header(data):
+    """Returns the index of a pack given at least its leading bytes,
+       or None if data does not hold the complete header."""
+
+    magic, version, header_len = PREFIX.unpack(data[:PREFIX.size])
+    if magic != MAGIC or version != VERSION:
+        raise Exception("not an image pack (version %d)" % (version,))
+
+    end = PREFIX.size + header_len
+    if len(data) < end:
+        return None
+
+    return json.loads(data[PREFIX.size:end])['pages']
+
+def read_index(key):
+    """Reads the index of the pack stored in S3 key"""
+    data = key.get_contents_as_string(headers={'Range': 'bytes=0-%d' % (HEADER_FETCH_SIZE - 1,)})
+    index = parse_header(data)
+    if index is None:
+        _, _, header_len = PREFIX.unpack(data[:PREFIX.size])
+        data = key.get_contents_as_string(headers={'Range': 'bytes=0-%d' % (PREFIX.size + header_len - 1,)})
+        index = parse_header(data)
+    return index
+
+def read_page(key, number, index=None):
+    """Returns the image of page number from the pack stored in S3 key.
+       Reads the index first unless it is provided."""
+    if index is None:
+        index = read_index(key)
+
+    for page, offset, size in index:
+        if page == int(number):
+            return key.get_contents_as_string(headers={'Range': 'bytes=%d-%d' % (offset, offset + size - 1)})
+
+    raise KeyError("no page %s in pack" % (number,))
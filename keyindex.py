@@ -0,0 +1,92 @@
+#!/bin/env python
+
+"""
+keyindex.py keeps a local, persistent record of extracted text keys
+so workers can tell whether a document has already been extracted without
+asking S3.
+
+The index is an sqlite file. It can be primed from a listing of the text
+bucket or from a snapshot file containing one key name per line, and is
+updated by the worker as it stores results. It only knows about work done
+by the local node after priming, so re-prime it, or hand out a fresh
+snapshot, before large runs.
+
+usage:
+
+  import keyindex
+
+  index = keyindex.KeyIndex('/var/tmp/extracted.db')
+  index.prime_from_file('extracted-keys.txt')
+
+  if not index.contains('1234.txt'):
+     ...
+     index.add('1234.txt')
+
+or, from the command line, to prime an index from a snapshot file:
+
+  python keyindex.py index-file snapshot-file
+
+"""
+
+import sqlite3
+import threading
+
+# number of keys written per transaction while priming
+CHUNK_SIZE = 10000
+
+class KeyIndex(object):
+    """A set of key names backed by an sqlite file. Safe to share between threads."""
+
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS extracted (key TEXT PRIMARY KEY)")
+        self.db.commit()
+
+    def contains(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT 1 FROM extracted WHERE key = ?", (key,)).fetchone()
+        return row is not None
+
+    def add(self, key):
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO extracted (key) VALUES (?)", (key,))
+            self.db.commit()
+
+    def add_many(self, keys):
+        """Adds keys from an iterable, committing every CHUNK_SIZE keys.
+           Returns the number of keys seen."""
+        count = 0
+        chunk = []
+        for key in keys:
+            chunk.append((key,))
+            if len(chunk) == CHUNK_SIZE:
+                count += self._insert(chunk)
+                chunk = []
+        if chunk:
+            count += self._insert(chunk)
+        return count
+
+    def _insert(self, chunk):
+        with self.lock:
+            self.db.executemany("INSERT OR IGNORE INTO extracted (key) VALUES (?)", chunk)
+            self.db.commit()
+        return len(chunk)
+
+    def prime_from_bucket(self, bucket):
+        """Adds the text keys in bucket"""
+        return self.add_many(entry.key for entry in bucket.list() if entry.key.endswith('.txt'))
+
+    def prime_from_file(self, filename):
+        """Adds the keys listed, one per line, in filename"""
+        with open(filename) as f:
+            return self.add_many(line.strip() for line in f if line.strip())
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+if __name__ == "__main__":
+    import sys
+    index = KeyIndex(sys.argv[1])
+    print index.prime_from_file(sys.argv[2])
@@ -0,0 +1,346 @@
+#!/bin/env python
+
+"""
+localbackend.py provides on-disk stand-ins for the SQS queues and S3 buckets
+used by task.py, so that the whole pipeline can run on a single machine, or
+offline, without AWS.
+
+Only the parts of the boto interfaces that task.py uses are implemented.
+
+Queues are directories under <root>/queues. Each message is a file in ready/.
+A receiver claims a message by renaming it into inflight/, which is atomic, so
+any number of processes can share a queue. The file's modification time is
+the end of its visibility timeout; expired messages are moved back to ready/
+by the next receiver. Deleting a message removes its inflight file. Messages
+are written to tmp/ and renamed into place, so a crash never leaves a partial
+message behind.
+
+Buckets are directories under <root>/buckets, one file per key. Each file
+starts with a line of JSON holding the key's metadata, followed by the
+contents. Files are also written to a temporary name and renamed.
+
+usage:
+
+  import localbackend
+
+  sqs_conn = localbackend.QueueConnection('local')
+  queue = sqs_conn.get_queue('extraction-job-development')
+
+  s3_conn = localbackend.StorageConnection('local')
+  bucket = s3_conn.get_bucket('ppi-extraction-text-development')
+
+"""
+
+import os
+import os.path as path
+import base64
+import errno
+import json
+import re
+import shutil
+import time
+import uuid
+import threading
+
+import boto.exception
+
+def ensure_dir(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def write_atomically(filename, tmpdir, data):
+    """Writes data to filename through a temporary file in tmpdir,
+       which must be on the same filesystem"""
+    tmp = path.join(tmpdir, uuid.uuid4().hex)
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, filename)
+
+class Message(object):
+    """A received message. The body is stored encoded, as SQS stores it."""
+
+    def __init__(self, queue, receipt_handle, encoded):
+        self.queue = queue
+        self.receipt_handle = receipt_handle
+        self.id = receipt_handle.split('.')[0]
+        self.encoded = encoded
+
+    def get_body(self):
+        return base64.b64decode(self.encoded)
+
+    def get_body_encoded(self):
+        return self.encoded
+
+class BatchResults(object):
+    def __init__(self):
+        self.results = []
+        self.errors = []
+
+class Queue(object):
+    """A durable message queue in a directory"""
+
+    # seconds between checks for messages while long polling
+    POLL_INTERVAL = 0.5
+
+    def __init__(self, directory, visibility_timeout=30):
+        self.directory = directory
+        self.name = path.basename(directory)
+        self.visibility_timeout = visibility_timeout
+        self.ready = path.join(directory, 'ready')
+        self.inflight = path.join(directory, 'inflight')
+        self.tmp = path.join(directory, 'tmp')
+        self.listed = []
+        self.lock = threading.Lock()
+
+        for d in (self.ready, self.inflight, self.tmp):
+            ensure_dir(d)
+
+    def put(self, encoded):
+        # names sort in the order messages were written
+        name = '%016d-%s' % (time.time() * 1e6, uuid.uuid4().hex)
+        write_atomically(path.join(self.ready, name), self.tmp, encoded)
+        return name
+
+    def write(self, message, delay_seconds=None):
+        self.put(message.get_body_encoded())
+        return message
+
+    def write_batch(self, messages):
+        """Writes messages, a list of (id, encoded body, delay) tuples"""
+        results = BatchResults()
+        for idx, body, delay in messages:
+            try:
+                self.put(body)
+            except (IOError, OSError) as e:
+                results.errors.append({'id': idx, 'code': 'IOError', 'message': str(e)})
+            else:
+                results.results.append({'id': idx})
+        return results
+
+    def requeue_expired(self):
+        """Moves messages whose visibility timeout has passed back to ready"""
+        now = time.time()
+        for receipt in os.listdir(self.inflight):
+            filename = path.join(self.inflight, receipt)
+            try:
+                if os.stat(filename).st_mtime < now:
+                    os.rename(filename, path.join(self.ready, receipt.split('.')[0]))
+            except OSError:
+                pass # deleted or claimed by another process
+
+    def claim(self, count, visibility_timeout):
+        """Claims up to count ready messages"""
+        messages = []
+
+        with self.lock:
+            if not self.listed:
+                self.requeue_expired()
+                self.listed = sorted(os.listdir(self.ready), reverse=True)
+
+            while self.listed and len(messages) < count:
+                name = self.listed.pop()
+                receipt = '%s.%s' % (name, uuid.uuid4().hex[:8])
+                filename = path.join(self.inflight, receipt)
+                deadline = time.time() + visibility_timeout
+                try:
+                    # the deadline is set before the move, so a receiver
+                    # requeueing expired messages never sees it without one.
+                    os.utime(path.join(self.ready, name), (deadline, deadline))
+                    os.rename(path.join(self.ready, name), filename)
+                    with open(filename, 'rb') as f:
+                        messages.append(Message(self, receipt, f.read()))
+                except (IOError, OSError):
+                    continue # claimed by another process
+
+        return messages
+
+    def get_messages(self, num_messages=1, visibility_timeout=None, wait_time_seconds=None, **kwargs):
+        if visibility_timeout is None:
+            visibility_timeout = self.visibility_timeout
+
+        deadline = time.time() + (wait_time_seconds or 0)
+        while True:
+            messages = self.claim(num_messages, visibility_timeout)
+            if messages or time.time() >= deadline:
+                return messages
+            time.sleep(self.POLL_INTERVAL)
+
+    def delete(self, message):
+        try:
+            os.remove(path.join(self.inflight, message.receipt_handle))
+        except OSError:
+            pass # already deleted or redelivered
+        return True
+
+    def change_visibility(self, message, visibility_timeout):
+        deadline = time.time() + visibility_timeout
+        try:
+            os.utime(path.join(self.inflight, message.receipt_handle), (deadline, deadline))
+        except OSError:
+            return False
+        return True
+
+    def count(self):
+        return len(os.listdir(self.ready))
+
+class QueueConnection(object):
+    """Queues under root, with the SQS connection methods task.py uses"""
+
+    def __init__(self, root):
+        self.root = path.join(root, 'queues')
+
+    def get_queue(self, name):
+        return Queue(path.join(self.root, name))
+
+    def delete_message(self, queue, message):
+        return queue.delete(message)
+
+    def delete_message_batch(self, queue, messages):
+        results = BatchResults()
+        for message in messages:
+            queue.delete(message)
+            results.results.append({'id': message.id})
+        return results
+
+    def change_message_visibility_batch(self, queue, messages):
+        """messages is a list of (message, visibility timeout) pairs"""
+        results = BatchResults()
+        for message, timeout in messages:
+            if queue.change_visibility(message, timeout):
+                results.results.append({'id': message.id})
+            else:
+                results.errors.append({'id': message.id, 'code': 'ReceiptHandleIsInvalid'})
+        return results
+
+def not_found(bucket, name):
+    return boto.exception.S3ResponseError(404, 'Not Found', '%s/%s does not exist' % (bucket, name))
+
+RANGE_RE = re.compile(r'bytes=(\d+)-(\d*)$')
+
+class Key(object):
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.key = self.name = name
+        self.metadata = {}
+
+    def filename(self):
+        return self.bucket.filename(self.key)
+
+    def set_metadata(self, name, value):
+        self.metadata[name] = value
+
+    def get_metadata(self, name):
+        return self.metadata.get(name)
+
+    def set_contents_from_string(self, data, headers=None):
+        filename = self.filename()
+        ensure_dir(path.dirname(filename))
+        write_atomically(filename, self.bucket.tmp, json.dumps(self.metadata) + '\n' + data)
+
+    def set_contents_from_filename(self, source, headers=None):
+        with open(source, 'rb') as f:
+            self.set_contents_from_string(f.read(), headers)
+
+    def load_metadata(self, f):
+        self.metadata = json.loads(f.readline())
+
+    def get_contents_as_string(self, headers=None):
+        """Returns the contents, or the part of it given by a Range header"""
+        try:
+            f = open(self.filename(), 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise not_found(self.bucket.name, self.key)
+            raise
+
+        with f:
+            self.load_metadata(f)
+
+            m = RANGE_RE.match((headers or {}).get('Range', ''))
+            if not m:
+                return f.read()
+
+            start = f.tell()
+            f.seek(start + int(m.group(1)))
+            if m.group(2):
+                return f.read(int(m.group(2)) - int(m.group(1)) + 1)
+            return f.read()
+
+class Bucket(object):
+    """A directory of keys, with the S3 bucket methods task.py uses"""
+
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.name = name
+        self.directory = path.join(connection.root, name)
+        self.tmp = path.join(connection.root, '.tmp')
+        ensure_dir(self.directory)
+        ensure_dir(self.tmp)
+
+    def filename(self, name):
+        if name.startswith('/') or '..' in name.split('/'):
+            raise ValueError("invalid key name: " + name)
+        return path.join(self.directory, name)
+
+    def new_key(self, name):
+        return Key(self, name)
+
+    def get_key(self, name):
+        key = Key(self, name)
+        try:
+            with open(key.filename(), 'rb') as f:
+                key.load_metadata(f)
+        except IOError:
+            return None
+        return key
+
+    def list(self, prefix='', marker=''):
+        """Yields the keys that start with prefix and sort after marker, in order"""
+        names = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            relative = path.relpath(dirpath, self.directory)
+            for filename in filenames:
+                name = filename if relative == '.' else relative + '/' + filename
+                if name.startswith(prefix) and name > marker:
+                    names.append(name)
+
+        for name in sorted(names):
+            yield Key(self, name)
+
+    def copy_key(self, new_name, src_bucket_name, src_key_name):
+        source = self.connection.get_bucket(src_bucket_name).filename(src_key_name)
+        target = self.filename(new_name)
+        ensure_dir(path.dirname(target))
+        tmp = path.join(self.tmp, uuid.uuid4().hex)
+        shutil.copyfile(source, tmp)
+        os.rename(tmp, target)
+        return Key(self, new_name)
+
+    def delete_key(self, name):
+        try:
+            os.remove(self.filename(name))
+        except OSError:
+            pass
+
+    def delete_keys(self, names, quiet=False):
+        for name in names:
+            self.delete_key(name)
+
+class StorageConnection(object):
+    """Buckets under root, with the S3 connection methods task.py uses.
+       Buckets need no setup; they are created when first used."""
+
+    def __init__(self, root):
+        self.root = path.join(root, 'buckets')
+
+    def get_bucket(self, name, validate=False):
+        return Bucket(self, name)
+
+    def lookup(self, name, validate=False):
+        return Bucket(self, name)
@@ -0,0 +1,250 @@
+#!/bin/env python
+
+"""
+metrics.py records counters and latency histograms for each pipeline stage
+and periodically writes them to a local metrics file.
+
+Counters count events and quantities (documents, pages, errors). Histograms
+record durations, in seconds, and are named with a _seconds suffix. Each time
+the metrics are written, the rate of every counter over the interval since
+the previous write is reported too, as <counter>_per_second, which gives
+pages per second and the like.
+
+Every process writes its own file, named after the process (see
+process_name), so that a restarted process takes over the file, and the
+series, of the one before it. In Prometheus text format, the file is
+rewritten each time, ready for the node exporter's textfile collector. In
+JSON lines format, a snapshot is appended each time. Processes that run side
+by side under the same name need %(pid)d in the file name to keep apart, at
+the cost of a new file, which nothing removes, for every run.
+
+Settings, in the [metrics] section of the config file:
+
+  file       metrics file (default metrics/<process>.prom in the
+             application directory), or none to disable metrics.
+             %(process)s and %(pid)d are replaced.
+  format     prometheus or json (default json for .json and .jsonl
+             files, prometheus otherwise)
+  interval   seconds between writes (default 15)
+
+Extraction steps are timed per page (extract_rasterize_seconds,
+extract_cleanup_seconds, extract_ocr_seconds) only with
+default.extract-engine = python, where rasterize and cleanup times are those
+of a run of pages split evenly between its pages. The extract script times its
+steps per document instead (extract_script_images_seconds,
+extract_script_text_layer_seconds, extract_script_rasterize_seconds,
+extract_script_cleanup_ocr_seconds), with cleanup and OCR together.
+
+usage:
+
+  import metrics
+
+  metrics.inc('extract_pages_total', pages)
+
+  with metrics.timer('collect_db_write_seconds'):
+      ...
+
+  metrics.observe('fetch_seconds', elapsed)
+
+"""
+
+import os
+import os.path as path
+import sys
+import re
+import json
+import time
+import threading
+import atexit
+import bisect
+
+import dictconfig
+
+# histogram bucket upper bounds, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+setting = dictconfig.section('metrics')
+
+# the process name, if set before the first metric is recorded, instead of
+# one derived from the command line. Needed by processes forked to run side
+# by side, such as the workers of task.process_local.
+PROCESS = None
+
+def process_name():
+    """Names the process after its script and action, e.g. task-extract"""
+    if PROCESS:
+        return PROCESS
+    name = path.splitext(path.basename(sys.argv[0]))[0] or 'python'
+    if len(sys.argv) > 1 and re.match(r'\w+$', sys.argv[1]):
+        name += '-' + sys.argv[1]
+    return name
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """Returns (upper bound, count) pairs, ending with '+Inf'"""
+        total = 0
+        result = []
+        for bound, count in zip(BUCKETS + ('+Inf',), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+class Registry(object):
+    """The metrics of one process and the thread that writes them out"""
+
+    def __init__(self, filename, format, interval):
+        self.filename = filename
+        self.format = format
+        self.interval = interval
+        self.pid = os.getpid()
+        self.process = process_name()
+        self.counters = {}
+        self.histograms = {}
+        self.last_counters = {}
+        self.last_time = time.time()
+        self.lock = threading.Lock()
+
+        directory = path.dirname(filename)
+        if directory and not path.isdir(directory):
+            os.makedirs(directory)
+
+        writer = threading.Thread(target=self.run)
+        writer.daemon = True
+        writer.start()
+
+    def inc(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.write()
+
+    def snapshot(self):
+        """Returns the counters, their rates since the last snapshot and the histograms"""
+        with self.lock:
+            now = time.time()
+            elapsed = max(now - self.last_time, 1e-6)
+            counters = dict(self.counters)
+            rates = dict((name, (value - self.last_counters.get(name, 0)) / elapsed)
+                         for name, value in counters.iteritems())
+            histograms = dict((name, (h.cumulative(), h.sum, h.count))
+                              for name, h in self.histograms.iteritems())
+            self.last_counters = counters
+            self.last_time = now
+        return now, counters, rates, histograms
+
+    def write(self):
+        try:
+            now, counters, rates, histograms = self.snapshot()
+            if self.format == 'json':
+                self.write_json(now, counters, rates, histograms)
+            else:
+                self.write_prometheus(counters, rates, histograms)
+        except Exception as e:
+            sys.stderr.write("metrics: cannot write %s: %s\n" % (self.filename, e))
+
+    def write_json(self, now, counters, rates, histograms):
+        record = {'time': now, 'process': self.process, 'pid': self.pid,
+                  'counters': counters, 'rates': rates,
+                  'histograms': dict((name, {'count': count, 'sum': total,
+                                             'buckets': [[str(bound), n] for bound, n in buckets]})
+                                     for name, (buckets, total, count) in histograms.iteritems())}
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def write_prometheus(self, counters, rates, histograms):
+        labels = 'process="%s"' % (self.process,)
+        lines = []
+
+        for name in sorted(counters):
+            lines.append('# TYPE %s counter' % (name,))
+            lines.append('%s{%s} %s' % (name, labels, counters[name]))
+            lines.append('# TYPE %s_per_second gauge' % (name,))
+            lines.append('%s_per_second{%s} %.6f' % (name, labels, rates[name]))
+
+        for name in sorted(histograms):
+            buckets, total, count = histograms[name]
+            lines.append('# TYPE %s histogram' % (name,))
+            for bound, n in buckets:
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bound, n))
+            lines.append('%s_sum{%s} %.6f' % (name, labels, total))
+            lines.append('%s_count{%s} %d' % (name, labels, count))
+
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(tmp, self.filename)
+
+REGISTRY = None
+REGISTRY_LOCK = threading.Lock()
+
+def registry():
+    """Returns this process's registry, or None if metrics are disabled.
+       A process forked from one with a registry starts its own."""
+    global REGISTRY
+    with REGISTRY_LOCK:
+        if REGISTRY is None or (REGISTRY and REGISTRY.pid != os.getpid()):
+            filename = setting('file', path.join(path.dirname(path.abspath(sys.argv[0])),
+                                                 'metrics/%(process)s.prom'))
+            if filename and filename != 'none':
+                filename = filename % {'process': process_name(), 'pid': os.getpid()}
+                format = setting('format', 'json' if filename.endswith(('.json', '.jsonl')) else 'prometheus')
+                REGISTRY = Registry(filename, format, float(setting('interval', 15)))
+                atexit.register(REGISTRY.write)
+            else:
+                REGISTRY = False
+    return REGISTRY
+
+def inc(name, amount=1):
+    """Adds amount to counter name"""
+    r = registry()
+    if r:
+        r.inc(name, amount)
+
+def observe(name, value):
+    """Records value, usually a duration in seconds, in histogram name"""
+    r = registry()
+    if r:
+        r.observe(name, value)
+
+def flush():
+    """Writes the metrics now. Processes that exit without running atexit
+       handlers, such as multiprocessing workers, call this before they end."""
+    r = registry()
+    if r:
+        r.write()
+
+class timer(object):
+    """Context manager that records the time spent in its block in histogram name"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.time() - self.start
+        observe(self.name, self.elapsed)
+        return False
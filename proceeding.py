@@ -14,6 +14,10 @@ Search the FCC site for all proceedings we care about.
 Grab all relevant filings and add them to the table.
 Existing records will fail and new records will succeed.
 
+To keep the brutishness cheap, comments already in the table for a
+proceeding are skipped before their pages are fetched. The unique index
+remains the final arbiter.
+
 The initial search can be run with the command:
 
     python proceeding.py search
@@ -26,9 +30,14 @@ It can be run once a day, perhap under cron, with the command
   python proceeding.py rss 
 
 Note that the RSS feed data spans 30 days of records, so if the updates lapse
-for more than 30 days, a search update must be run (once) to catch up before
+for more than 30 days, a catchup update must be run (once) to catch up before
 restarting with the rss feeds.
 
+  python proceeding.py catchup
+
+This is a search that stops at the first page of results holding only
+comments we already have.
+
 The script uses the RAILS_ENV environment variable to determine run modes
 so this should be set, either implicitly 
 
@@ -51,26 +60,44 @@ Author: Gyepi Sam <self-github@gyepi.com>
 """
 
 import re
+import bisect
+from array import array
 import lxml
 from utils import *
 import db
 import comment
-
-def parse_proceeding_search(proceeding_num):
+import fetch
+import metrics
+
+def comment_links(content):
+    """Returns the comment urls on a search results page"""
+    with metrics.timer('search_parse_seconds'):
+        links = [hostify_url(clean_url(href))
+                 for href in content.xpath('//a[contains(@href, "/ecfs/comment/view")]/@href')]
+    metrics.inc('search_pages_total')
+    metrics.inc('search_links_total', len(links))
+    return links
+
+def parse_proceeding_search(proceeding_num, known=None, incremental=False, pagesize=None):
     """A generator that runs a search on FCC site and produces
-    urls for comments and documents relating to specified proceeding number"""
+    urls for comments and documents relating to specified proceeding number.
+
+    Result pages are fetched concurrently, a window at a time. With incremental
+    set, the search stops at the first page on which every comment is in known,
+    on the assumption that the remaining, older, pages hold nothing new."""
+
+    if pagesize is None:
+        pagesize = fetch.setting('search-page-size', 100)
 
     # In addition to search results, the first page also contains
     # links to subsequent pages
     # which will be subsequently followed.
 
     try:
-        url = search_url(proceeding_num)
+        url = search_url(proceeding_num, pagesize)
     
-        content = lxml.html.parse(url)
+        content = lxml.html.document_fromstring(fetch.get(url))
     
-        todo = [content] # addenda...
-
         pages = [] # pages to follow and process
         cache = {} # ensure unique set
 
@@ -92,39 +119,101 @@ def parse_proceeding_search(proceeding_num):
 
         lastpage_match = re.match('(.+pageNumber=)(\d+)', lastpage)
         penultimate_match = re.match('(.+pageNumber=)(\d+)', pages[-1])
-        for number in range(int(penultimate_match.group(2)) + 1, int(lastpage_match.group(2)) - 1):
+        for number in range(int(penultimate_match.group(2)) + 1, int(lastpage_match.group(2))):
             pages.append(lastpage_match.group(1) + str(number))
 
         pages.append(lastpage)
 
-    todo.extend(pages)
-      
-    for item in todo:
-        if hasattr(item, 'xpath'):
-            content = item 
-        else:
+    def exhausted(links):
+        return incremental and known is not None and links and \
+            all(comment.comment_number(link) in known for link in links)
+
+    links = comment_links(content)
+    for link in links:
+        yield link
+
+    if exhausted(links):
+        return
+
+    window = int(fetch.setting('concurrency', 4))
+
+    for start in range(0, len(pages), window):
+        batch = pages[start:start + window]
+
+        fetched = {}
+        for item, body, error in fetch.fetch_all(batch, window):
+            if error:
+                warn("Error fetching or parsing link", item, error)
+            else:
+                fetched[item] = body
+
+        # pages are handled in order so that stopping early is safe
+        for item in batch:
+            if item not in fetched:
+                continue
+
             try:
-                content = lxml.html.parse(item)
+                links = comment_links(lxml.html.document_fromstring(fetched[item]))
             except Exception as e:
                 warn("Error fetching or parsing link", item, e)
                 continue
 
-        for href in content.xpath('//a[contains(@href, "/ecfs/comment/view")]/@href'):
-            yield hostify_url(clean_url(href))
+            for link in links:
+                yield link
+
+            if exhausted(links):
+                return
+
+def parse_proceeding_catchup(proceeding_num, known=None):
+    """Incremental search. Useful to catch up after rss updates have lapsed"""
+    return parse_proceeding_search(proceeding_num, known, incremental=True)
 
-def parse_proceeding_rss(proceeding_num):
+def parse_proceeding_rss(proceeding_num, known=None):
     """Parse comment urls out of rss feed. This is faster and less resource
        intensive and perfect for incremental updates"""
 
     url = rss_url(proceeding_num)
-    content = lxml.etree.parse(url)
+    content = lxml.etree.fromstring(fetch.get(url))
 
     for href in content.xpath('/rss/channel/item/link/text()'):
         yield href
 
+class KnownNumbers(object):
+    """A compact set of fcc_nums, stored as a sorted array of integers"""
+
+    def __init__(self, numbers):
+        self.numbers = array('L', sorted(int(n) for n in numbers if n and n.isdigit()))
+
+    def __contains__(self, fcc_num):
+        if not fcc_num or not fcc_num.isdigit():
+            return False
+        value = int(fcc_num)
+        idx = bisect.bisect_left(self.numbers, value)
+        return idx < len(self.numbers) and self.numbers[idx] == value
+
+    def __len__(self):
+        return len(self.numbers)
+
+def known_comments(proceeding_id):
+    """Returns the fcc_nums of the comments already imported for a proceeding"""
+    cur = db.connection().cursor()
+    cur.execute("SELECT fcc_num FROM filings WHERE proceeding_id = %s", (proceeding_id,))
+    known = KnownNumbers(row[0] for row in cur)
+    db.connection().commit()
+    return known
+
+def new_comments(urls, known):
+    """A generator that filters out urls of known comments"""
+    for url in urls:
+        if comment.comment_number(url) not in known:
+            yield url
+
 def import_comments(proceeding_parser):
     """imports all proceeding comments into filing table and documents into
-       filing_docs table. proceeding_parser is either based on a search or an rss feed"""
+       filing_docs table. proceeding_parser is either based on a search or an rss feed.
+       Comments that are already in the database are skipped without being fetched.
+       Comment pages are fetched concurrently (see fetch.py) while this thread
+       parses and stores the ones that have arrived."""
 
     conn = db.connection()
     cur = conn.cursor()
@@ -139,16 +228,34 @@ def import_comments(proceeding_parser):
     conn.commit()
 
     for proceeding_id, number in proceedings:
-        for url in proceeding_parser(number):
-            comment.import_comment(proceeding_id, url)
+        known = known_comments(proceeding_id)
+        urls = new_comments(proceeding_parser(number, known), known)
 
-    conn.close()
+        batch = comment.CommentBatch()
+
+        # a parse error in urls ends the import, after the comments
+        # fetched before it are stored.
+        try:
+            for url, content, error in fetch.fetch_all(urls):
+                if error:
+                    warn("Error %s fetching comment: %s" % (error, url))
+                    continue
+                batch.add(proceeding_id, url, content)
+        finally:
+            batch.flush()
+
+    db.release()
 
 def import_comments_search():
     """Imports comments based on searching for all comments. Useful for bulk
     loading"""
     import_comments(parse_proceeding_search)
 
+def import_comments_catchup():
+    """Imports comments based on a search that stops once it reaches pages of
+       known comments. Useful to catch up after rss updates have lapsed."""
+    import_comments(parse_proceeding_catchup)
+
 def import_comments_rss():
     """Imports comments mentioned in RSS feed, which only covers recent items.
        Useful for incremental updates."""
@@ -0,0 +1,284 @@
+#!/bin/env python
+
+"""
+search.py answers full text queries over the collected document pages.
+
+Queries use web search syntax: words are and-ed together, "quoted words" must
+appear as a phrase, OR separates alternatives and a leading - excludes a word.
+Results may be restricted to a proceeding and to a range of filing (received)
+dates, and are ranked by ts_rank_cd over the precomputed search vectors (see
+searchindex.py) and returned a page at a time.
+
+Queries are parsed with websearch_to_tsquery, which requires PostgreSQL 11
+or later.
+
+Snippets are cut out of the matching page text in Python, around the first
+occurrence of a query word, rather than by ts_headline, which re-parses every
+page it is given.
+
+Results are kept in an LRU cache for search.cache-ttl seconds, so pages
+written by the collector show up in searches within that time. Bulk writes,
+by the search backfill and collect_batch, are announced on
+searchindex.CHANNEL when they end, and a listener thread clears the cache
+when it hears one. The collector commits every few seconds, and clearing
+the cache on each of its commits would leave it nearly always empty.
+
+Settings, in the [search] section of the config file:
+
+  config         text search configuration (default english)
+  page-size      results per page (default 20)
+  cache-size     number of cached result pages (default 1000)
+  cache-ttl      seconds a cached result page is kept (default 600)
+  snippet-length approximate snippet length in characters (default 200)
+
+usage:
+
+  import search
+
+  results = search.search('"net neutrality" -comcast', proceeding='14-28',
+                          since='2014-07-01', page=2)
+
+  # from the command line
+  python search.py query [proceeding]
+
+"""
+
+import re
+import select
+import threading
+import time
+import collections
+
+import psycopg2
+import psycopg2.extensions
+
+from utils import *
+import db
+import searchindex
+
+setting = searchindex.setting
+
+WORD_RE = re.compile(r'"[^"]*"|\S+', re.UNICODE)
+
+class LRUCache(object):
+    """A thread safe least recently used cache whose entries expire after ttl seconds"""
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # bumped by clear, so that results computed before a clear are not stored after it
+        self.generation = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            stored, value = entry
+            if time.time() - stored > self.ttl:
+                return None
+            self.entries[key] = entry
+            return value
+
+    def put(self, key, value, generation=None):
+        with self.lock:
+            if generation is not None and generation != self.generation:
+                return
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time(), value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+CACHE = None
+CACHE_LOCK = threading.Lock()
+
+def cache():
+    """Returns the result cache, starting its invalidation listener"""
+    global CACHE
+    with CACHE_LOCK:
+        if CACHE is None:
+            CACHE = LRUCache(int(setting('cache-size', 1000)), float(setting('cache-ttl', 600)))
+            listener = threading.Thread(target=listen, args=(CACHE,))
+            listener.daemon = True
+            listener.start()
+    return CACHE
+
+def listen(cache):
+    """Clears cache whenever new pages are committed.
+       Runs forever on its own connection, reconnecting after errors."""
+
+    while True:
+        try:
+            conn = psycopg2.connect(db.connection_args())
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            conn.cursor().execute("LISTEN " + searchindex.CHANNEL)
+
+            # pages may have been committed while there was no listener.
+            cache.clear()
+
+            while True:
+                if select.select([conn], [], [], 60) == ([], [], []):
+                    continue
+                conn.poll()
+                if conn.notifies:
+                    del conn.notifies[:]
+                    cache.clear()
+        except Exception as e:
+            warn("search cache listener:", e)
+            cache.clear()
+            time.sleep(10)
+
+def query_words(query):
+    """Returns the words of query that a snippet should show,
+       leaving out operators and excluded words"""
+    words = []
+    for token in WORD_RE.findall(query):
+        if token.startswith('-') or token.upper() == 'OR':
+            continue
+        words.extend(re.findall(r'\w+', token, re.UNICODE))
+    return words
+
+def snippet(text, words, length=None):
+    """Returns about length characters of text around the first occurrence of
+       any of words, which are matched on their leading characters so that
+       other forms of the word are found as the stemmed search finds them."""
+
+    if length is None:
+        length = int(setting('snippet-length', 200))
+
+    if not text:
+        return ''
+
+    stems = [re.escape(w[:max(len(w) - 2, 4)]) for w in words if w]
+    match = None
+    if stems:
+        match = re.search(r'\b(?:%s)\w*' % ('|'.join(stems),), text, re.IGNORECASE | re.UNICODE)
+
+    start = max(match.start() - length / 3, 0) if match else 0
+    end = min(start + length, len(text))
+
+    # do not cut words in half
+    if start > 0:
+        space = text.find(' ', start)
+        if 0 <= space < (match.start() if match else end):
+            start = space + 1
+    if end < len(text):
+        space = text.rfind(' ', start, end)
+        if space > start:
+            end = space
+
+    return ('...' if start > 0 else '') + ' '.join(text[start:end].split()) + ('...' if end < len(text) else '')
+
+def search(query, proceeding=None, since=None, until=None, page=1, page_size=None):
+    """Returns a page of the results for query as a dict with the total number
+       of matching pages and a list of results, best first. Each result holds
+       the document, page number, filing details, rank and a snippet.
+       proceeding is a proceeding number; since and until bound the filing's
+       received date, inclusive."""
+
+    if page_size is None:
+        page_size = int(setting('page-size', 20))
+    page = max(int(page), 1)
+
+    key = (query, proceeding, since, until, page, page_size)
+    generation = cache().generation
+    found = cache().get(key)
+    if found is not None:
+        return found
+
+    conditions = ["p.%s @@ q" % (searchindex.COLUMN,)]
+    args = [searchindex.ts_config(), query]
+
+    if proceeding:
+        conditions.append("pr.number = %s")
+        args.append(proceeding)
+    if since:
+        conditions.append("f.recv_date >= %s")
+        args.append(since)
+    if until:
+        conditions.append("f.recv_date <= %s")
+        args.append(until)
+
+    matches = """
+            FROM doc_pages p
+            JOIN filing_docs d ON d.id = p.filing_doc_id
+            JOIN filings f ON f.id = d.filing_id
+            JOIN proceedings pr ON pr.id = f.proceeding_id,
+            websearch_to_tsquery(%%s::regconfig, %%s) q
+            WHERE %s
+            """ % (' AND '.join(conditions),)
+
+    conn = db.connection()
+    cur = conn.cursor()
+
+    try:
+        cur.execute("""
+            SELECT p.id, p.filing_doc_id, p.pagenumber, d.fcc_num, d.url,
+                   pr.number, f.applicant, f.recv_date,
+                   ts_rank_cd(p.%s, q) AS rank, count(*) OVER () AS total
+            %s
+            ORDER BY rank DESC, p.filing_doc_id, p.pagenumber
+            LIMIT %%s OFFSET %%s
+            """ % (searchindex.COLUMN, matches), args + [page_size, (page - 1) * page_size])
+
+        rows = cur.fetchall()
+
+        if rows:
+            total = rows[0][-1]
+        elif page > 1:
+            # past the last page, the window count is not available
+            cur.execute("SELECT count(*) " + matches, args)
+            total = cur.fetchone()[0]
+        else:
+            total = 0
+
+        # page text is read only for the pages shown, not for every match
+        texts = {}
+        if rows:
+            cur.execute("SELECT id, pagetext FROM doc_pages WHERE id = ANY(%s)", ([row[0] for row in rows],))
+            texts = dict(cur.fetchall())
+    finally:
+        conn.rollback()
+
+    words = query_words(query)
+
+    results = []
+    for page_id, filing_doc_id, pagenumber, fcc_num, url, number, applicant, recv_date, rank, total in rows:
+        results.append({
+            'filing_doc_id': filing_doc_id,
+            'fcc_num': fcc_num,
+            'url': url,
+            'pagenumber': pagenumber,
+            'proceeding': number,
+            'applicant': applicant,
+            'recv_date': recv_date,
+            'rank': rank,
+            'snippet': snippet(texts.get(page_id), words),
+            })
+
+    found = {'total': total, 'page': page, 'page_size': page_size,
+             'results': results}
+
+    cache().put(key, found, generation)
+    return found
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) < 2:
+        warn("usage: search.py query [proceeding]")
+        sys.exit(2)
+
+    found = search(sys.argv[1], *sys.argv[2:3])
+    print "%d matching pages" % (found['total'],)
+    for result in found['results']:
+        print "%.4f %s page %s (%s, %s)" % (result['rank'], result['fcc_num'], result['pagenumber'],
+                                             result['proceeding'], result['recv_date'])
+        print "    ", result['snippet']
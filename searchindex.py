@@ -0,0 +1,135 @@
+#!/bin/env python
+
+"""
+searchindex.py maintains the full text search index over doc_pages.
+
+Each page carries a precomputed tsvector in doc_pages.search_vector, with a
+GIN index over it. A trigger fills in the column whenever a page is inserted
+or its text changes, so every writer keeps it current from the moment create
+runs, and the backfill job fills it in for pages written before, in chunks
+that are committed separately so that it can be stopped and restarted at
+will. Bulk writes to doc_pages, by the backfill and collect_batch, are
+announced on the CHANNEL notification channel when they end.
+
+The text search configuration is taken from search.config in the config file
+(default english). The trigger is created with the configuration in effect
+at the time; run create again after changing it.
+
+usage:
+
+  # add the column, trigger and index. Safe to run again.
+  python searchindex.py create
+
+  # index existing pages, optionally starting after a given doc_pages id
+  python searchindex.py backfill [start-id]
+
+"""
+
+from utils import *
+import db
+import dictconfig
+
+COLUMN = 'search_vector'
+INDEX = 'doc_pages_search_vector_idx'
+TRIGGER = 'doc_pages_search_vector_update'
+
+# notified after bulk writes of pages, so that search caches can be dropped.
+CHANNEL = 'doc_pages_changed'
+
+setting = dictconfig.section('search')
+
+def ts_config():
+    """Returns the text search configuration name"""
+    return setting('config', 'english')
+
+def notify(conn):
+    """Announces new pages to listeners. Commits conn."""
+    conn.cursor().execute("NOTIFY " + CHANNEL)
+    conn.commit()
+
+def create():
+    """Adds the search column, the trigger that fills it in and its GIN index
+       to doc_pages. The column and trigger are added together, so that no
+       page written meanwhile is missed by both the trigger and the backfill.
+       The index is built concurrently so the collector can keep writing."""
+
+    # tsvector_update_trigger wants a schema qualified configuration
+    config = ts_config()
+    if '.' not in config:
+        config = 'pg_catalog.' + config
+
+    conn = db.connection()
+    cur = conn.cursor()
+    cur.execute("ALTER TABLE doc_pages ADD COLUMN IF NOT EXISTS %s tsvector" % (COLUMN,))
+    cur.execute("DROP TRIGGER IF EXISTS %s ON doc_pages" % (TRIGGER,))
+    cur.execute("""
+        CREATE TRIGGER %s BEFORE INSERT OR UPDATE OF pagetext ON doc_pages
+        FOR EACH ROW EXECUTE PROCEDURE tsvector_update_trigger(%s, '%s', pagetext)
+        """ % (TRIGGER, COLUMN, config.replace("'", "''")))
+    conn.commit()
+
+    conn.autocommit = True
+    try:
+        cur.execute("CREATE INDEX CONCURRENTLY IF NOT EXISTS %s ON doc_pages USING gin (%s)" % (INDEX, COLUMN))
+    finally:
+        conn.autocommit = False
+
+    db.release()
+
+def backfill(start_id=0, chunk_size=None):
+    """Computes search vectors for pages that lack them, chunk_size pages at a time
+       in doc_pages id order, committing after each chunk.
+       Reports the last id of each chunk, which can be given as start_id to resume.
+       A resumed run ends with a sweep from the first page, so that pages before
+       start_id that still lack a vector are indexed too."""
+
+    if chunk_size is None:
+        chunk_size = int(setting('backfill-chunk-size', 5000))
+
+    conn = db.connection()
+    cur = conn.cursor()
+
+    last_id = int(start_id)
+    swept = last_id == 0
+    total = 0
+
+    while True:
+        cur.execute("""
+            UPDATE doc_pages SET %s = to_tsvector(%%s::regconfig, coalesce(pagetext, ''))
+            WHERE id IN (
+                SELECT id FROM doc_pages
+                WHERE id > %%s AND %s IS NULL
+                ORDER BY id
+                LIMIT %%s)
+            RETURNING id
+            """ % (COLUMN, COLUMN), (ts_config(), last_id, chunk_size))
+
+        ids = [row[0] for row in cur.fetchall()]
+        conn.commit()
+
+        if not ids:
+            if swept:
+                break
+            last_id, swept = 0, True
+            continue
+
+        last_id = max(ids)
+        total += len(ids)
+        warn("backfill: indexed", total, "pages, last id", last_id)
+
+    notify(conn)
+    db.release()
+    return total
+
+if __name__ == "__main__":
+    import sys
+
+    action = sys.argv[1] if len(sys.argv) > 1 else None
+
+    if action == 'create':
+        create()
+    elif action == 'backfill':
+        backfill(*sys.argv[2:3])
+    else:
+        warn("usage: searchindex.py create | backfill [start-id]")
+        sys.exit(2)
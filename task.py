@@ -6,9 +6,16 @@
   inject finds new documents that require extraction and puts a task on the SQS queue.
   extract runs the extraction script and puts the resulting data on S3 and sets a result through SQS.
   collect retrieves the results of the work from SQS and S3 and updates the database.
+
+  With default.backend = local in config, queues and buckets are kept on the
+  local disk under default.local-root instead (see localbackend.py), and
+  process_local runs inject, a pool of extract processes and collect on
+  a single machine.
 """
 
 import json
+import os
+import hashlib
 import tempfile
 import os.path as path
 import subprocess
@@ -16,29 +23,59 @@ import re
 import glob
 import shutil
 import time
+import threading
+import Queue
+import signal
+import multiprocessing
 
 import boto.sqs
 from boto.sqs.message import Message
 from boto.s3.connection import S3Connection
-from boto.s3.key import Key
 import boto.exception
 
 from utils import *
 import db
 import dictconfig
+import extraction
+import keyindex
+import imagepack
+import textformat
+import searchindex
+import localbackend
+import metrics
+import tracing
 
 
 CONFIG = None
 VERBOSE = False
 
-def config(key):
+# SQS accepts at most this many messages per batch call.
+SQS_BATCH_SIZE = 10
+
+_NO_DEFAULT = object()
+
+def config(key, default=_NO_DEFAULT):
+    """Returns config value for key. If the key is missing and a default is
+       provided, the default is returned instead."""
     global CONFIG
     if not CONFIG:
         CONFIG = dictconfig.parse()
 
-    return CONFIG[key]
+    if default is _NO_DEFAULT:
+        return CONFIG[key]
+
+    return CONFIG.get(key, default)
+
+def local_root():
+    """Returns the directory of the local backend's queues and buckets"""
+    return config('default.local-root', path.join(path.dirname(path.abspath(__file__)), 'local'))
+
+def is_local():
+    return config('default.backend', 'aws') == 'local'
 
 def get_sqs_connection():
+    if is_local():
+        return localbackend.QueueConnection(local_root())
     return boto.sqs.connect_to_region(config('aws.region'))
 
 def get_queue(sqs_conn, name):
@@ -53,6 +90,8 @@ def get_queue(sqs_conn, name):
     return queue
 
 def get_s3_connection():
+    if is_local():
+        return localbackend.StorageConnection(local_root())
     return S3Connection()
 
 def dict_to_msg(data):
@@ -64,22 +103,166 @@ def msg_to_dict(msg):
     return json.loads(msg.get_body())
 
 
-def inject_by_query(query):
-    """Inject documents based on query results"""
+def send_batches(jobs, queue_name, errors):
+    """Sender thread body. Reads lists of dicts from the jobs queue
+       and writes them to the named SQS queue, up to SQS_BATCH_SIZE per call.
+       Entries that fail are retried a few times before being dropped;
+       inject will pick them up again once they are stale.
+       If the queue cannot be opened, the error is added to errors and the
+       sender ends (see put_job)."""
+
+    # boto connections are not thread safe so each sender has its own.
+    try:
+        sqs_conn = get_sqs_connection()
+        queue = get_queue(sqs_conn, queue_name)
+    except Exception as e:
+        warn("inject: sender cannot open queue", queue_name, e)
+        errors.append(e)
+        return
+
+    retries = int(config('default.inject-retries', 5))
+
+    while True:
+        batch = jobs.get()
+        if batch is None:
+            jobs.task_done()
+            break
+
+        pending = dict((str(idx), dict_to_msg(data).get_body_encoded()) for idx, data in enumerate(batch))
+
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(min(2 ** attempt, 30))
+
+            try:
+                result = queue.write_batch([(idx, body, 0) for idx, body in pending.iteritems()])
+            except Exception as e:
+                warn("inject: batch send failed", e)
+                continue
+
+            for entry in result.results:
+                pending.pop(entry['id'], None)
+
+            if not pending:
+                break
+
+            for entry in result.errors:
+                warn("inject: message rejected", entry.get('code'), entry.get('message'))
+
+        for idx in pending:
+            warn("inject: giving up on", batch[int(idx)])
+
+        jobs.task_done()
+
+def put_job(jobs, batch, senders, errors):
+    """Puts batch on the jobs queue for the sender threads. Raises the
+       senders' error instead of waiting forever once none of them is left."""
+    while True:
+        try:
+            jobs.put(batch, timeout=1)
+            return
+        except Queue.Full:
+            if not any(t.is_alive() for t in senders):
+                raise errors[0] if errors else Exception("inject: no sender is running")
+
+def part_keyname(fcc_num, part):
+    """S3 key name for the text of one page range of a split document"""
+    return "%s.part-%d.txt" % (fcc_num, part)
+
+def work_units(filing_doc_id, fcc_num, url, pagecount):
+    """Returns a list of task dicts for a document.
+       Documents with more than default.split-pages pages are split into
+       page ranges of that size, which are extracted independently and merged
+       by the collector."""
+
+    data = dict(filing_doc_id=filing_doc_id, fcc_num=fcc_num, url=url)
+
+    split = int(config('default.split-pages', 0))
+    try:
+        pagecount = int(pagecount)
+    except (TypeError, ValueError):
+        pagecount = 0
+
+    if not split or pagecount <= split:
+        return [data]
+
+    parts = (pagecount + split - 1) / split
+    units = []
+    for part in range(parts):
+        unit = dict(data, part=part, parts=parts,
+                    first_page=part * split + 1,
+                    last_page=min((part + 1) * split, pagecount))
+        units.append(unit)
+
+    return units
+
+def inject_by_query(query, mark_queued=True):
+    """Inject documents based on query results.
+       query must be a SELECT producing (id, fcc_num, url, pagecount) rows. Rows are read
+       through a server side cursor and handed to a pool of sender threads in
+       batches. If mark_queued is true, the rows are marked as queued."""
     conn = db.connection()
-    cur = conn.cursor()
+    cur = conn.cursor(name='inject_by_query')
+    cur.itersize = int(config('default.inject-fetch-size', 1000))
+    update_cur = conn.cursor()
 
-    sqs_conn = get_sqs_connection()
-    queue = get_queue(sqs_conn, config('default.injector-queue'))
-    
+    senders = int(config('default.inject-senders', 4))
+    jobs = Queue.Queue(maxsize=senders * 4)
+    queue_name = config('default.injector-queue')
+
+    # Fail early if the queue is missing rather than in every thread.
+    get_queue(get_sqs_connection(), queue_name)
+
+    errors = []
+    threads = []
+    for i in range(senders):
+        t = threading.Thread(target=send_batches, args=(jobs, queue_name, errors))
+        t.daemon = True
+        t.start()
+        threads.append(t)
 
     cur.execute(query)
 
-    for filing_doc_id, fcc_num, url in cur:
-        queue.write(dict_to_msg(dict(filing_doc_id=filing_doc_id, fcc_num=fcc_num, url=url)))  #TODO batch sends
+    count = 0
+    try:
+        while True:
+            rows = cur.fetchmany(cur.itersize)
+            if not rows:
+                break
+
+            if mark_queued:
+                update_cur.execute("UPDATE filing_docs SET status = 'queued' WHERE id = ANY(%s)",
+                                   ([row[0] for row in rows],))
+
+            units = []
+            for row in rows:
+                units.extend(work_units(*row))
+
+            for unit in units:
+                tracing.start(unit)
 
+            for i in range(0, len(units), SQS_BATCH_SIZE):
+                put_job(jobs, units[i:i + SQS_BATCH_SIZE], threads, errors)
+
+            count += len(rows)
+            metrics.inc('inject_documents_total', len(rows))
+            metrics.inc('inject_messages_total', len(units))
+    finally:
+        for t in threads:
+            try:
+                put_job(jobs, None, threads, errors)
+            except Exception:
+                break # every sender has ended
+
+        for t in threads:
+            t.join()
+
+    cur.close()
     conn.commit()
-    conn.close()
+    db.release()
+
+    if VERBOSE:
+        warn("injected", count)
 
 def inject(limit=None):
     """Submit extraction tasks to the queue.
@@ -91,97 +274,396 @@ def inject(limit=None):
         limit_phrase = ""
 
     query = """
-            WITH target_rows AS (
-                SELECT id FROM filing_docs 
-                WHERE status = 'new' OR
-                (status = 'queued' AND extract('day' from current_date - updated_at) > 1)
-                %s
-            )
-            UPDATE filing_docs SET status = 'queued' WHERE id IN (SELECT id FROM target_rows)
-            RETURNING id, fcc_num, url
+            SELECT id, fcc_num, url, pagecount FROM filing_docs
+            WHERE status = 'new' OR
+            (status = 'queued' AND extract('day' from current_date - updated_at) > 1)
+            %s
             """ % (limit_phrase,)
 
     return inject_by_query(query)
 
 def inject_number(fcc_num):
     """Injects a specific document into the queue"""
-    return inject_by_query("select id, fcc_num, url from filing_docs where fcc_num = '%s'" % (fcc_num,))
+    return inject_by_query("select id, fcc_num, url, pagecount from filing_docs where fcc_num = '%s'" % (fcc_num,),
+                           mark_queued=False)
 
-def extract(limit=None, queue_results=True):
-    """Extract texts of pdf files specified in queue.
-       Result files are placed in S3, along with associated metadata.
-       If queue_results is is true, result data is placed on the output queue.
-       This part can run on EC2 instances or the local machine if it has been
-       configured."""
+def store_text(bucket, keyname, result, content_str):
+    """Stores extracted text under keyname along with result metadata.
 
-    sqs_conn = get_sqs_connection()
-    in_queue = get_queue(sqs_conn, config('default.injector-queue'))
+       By default the text and page index are stored together in the compact
+       format (see textformat.py) and only the small result fields go in the
+       key's metadata. With default.text-format = legacy, the text is stored
+       as is and page offsets go in the key's metadata. When they do not fit,
+       the metadata is stored in a separate .meta key instead.
+       Errors are raised to the caller, which must not consider the text
+       stored."""
 
-    if queue_results:
-        out_queue = get_queue(sqs_conn, config('default.collector-queue'))
+    content_key = bucket.new_key(keyname)
 
-    s3_conn = get_s3_connection()
-    text_bucket = s3_conn.get_bucket(config('default.text-bucket'), validate=False)
-    image_bucket = s3_conn.get_bucket(config('default.image-bucket'), validate=False)
+    for name, value in result.iteritems():
+        if name not in ('pages', 'trace'):
+            content_key.set_metadata(name, str(value))
 
-    counter = 0
-    if limit:
-        limit = int(limit)
+    if config('default.text-format', 'compact') != 'legacy':
+        content_key.set_metadata('format', 'compact')
+        content_key.set_contents_from_string(textformat.encode(result.get('pages', []), content_str))
+        return
 
-    while True:
-        m = sqs_conn.receive_message(in_queue)
-        if not len(m):
-            time.sleep(5 * 60)
-            continue
+    for idx, page in enumerate(result.get('pages', [])):
+        for name, value in page.iteritems():
+            content_key.set_metadata('page.%d.%s' % (idx, name), str(value))
+
+    try:
+        content_key.set_contents_from_string(content_str)
+    except boto.exception.S3ResponseError as e:
+        warn("storing metadata separately for", keyname, e)
+        metadata = bucket.new_key(re.sub('\.txt$', '', keyname) + '.meta')
+        metadata.set_contents_from_string(json.dumps(result))
+
+        content_key = bucket.new_key(keyname)
+        content_key.set_metadata('metadata', metadata.key)
+        content_key.set_contents_from_string(content_str)
+
+def load_text(bucket, keyname):
+    """Returns the result metadata and text stored under keyname
+       or (None, None) if the key does not exist.
+       Reads both the compact and the legacy format. Either way, the GET
+       returns the metadata too, so no separate HEAD request is needed."""
+
+    key = bucket.new_key(keyname)
+    try:
+        body = key.get_contents_as_string()
+    except boto.exception.S3ResponseError as e:
+        if e.status == 404:
+            return None, None
+        raise
+
+    metadata_key = key.get_metadata('metadata')
+
+    if metadata_key:
+        o = bucket.new_key(metadata_key)
+        data = json.loads(o.get_contents_as_string())
+        if not data.get('pagecount'):
+            data['pagecount'] = len(data.get('pages', []))
+        return data, body
 
-        sqs_conn.delete_message(in_queue, m[0])
+    data = {}
+    for name in ('filing_doc_id', 'fcc_num', 'pagecount', 'status', 'part', 'parts'):
+        value = key.get_metadata(name)
+        if value is not None:
+            data[name] = value
 
-            
+    try:
+        data['pagecount'] = int(data['pagecount'])
+    except:
+        data['pagecount'] = 0
+
+    # legacy text may itself start with the compact magic, so only the
+    # format recorded when the text was stored is trusted
+    if key.get_metadata('format') == 'compact':
+        pages, body = textformat.decode(body)
+    else:
+        pages = []
+        for idx in range(data['pagecount']):
+            page = {}
+            for name in ('number', 'size', 'offset'):
+                page[name] = key.get_metadata('page.%d.%s' % (idx, name))
+            pages.append(page)
+
+    if len(pages):
+        data['pages'] = pages
+
+    return data, body
+
+def is_extracted(keyname, text_bucket, index=None):
+    """Checks the local key index, if there is one, or S3 for keyname"""
+    if index:
+        return index.contains(keyname)
+    return bool(text_bucket.get_key(keyname))
+
+def run_extraction(data, workdir, pdf):
+    """Extracts page images and text of pdf into workdir, using the configured
+       engine. Returns 0 on success."""
+
+    if config('default.extract-engine', 'script') == 'python':
         try:
-            data = msg_to_dict(m[0])
-            warn("extract: input", data)
-        except:
-            warn("cannot extract data from", m[0].get_body())
-            continue
+            stats = extraction.extract(data['url'], workdir, pdf,
+                                       first_page=data.get('first_page'),
+                                       last_page=data.get('last_page'))
+            warn("extract: stats", data['fcc_num'], stats)
+            return 0
+        except Exception as e:
+            warn("extract: extraction failed", data, e)
+            return 1
+
+    script = path.join(path.abspath(path.dirname(sys.argv[0])), 'extract')
+    env = dict(os.environ)
+    if data.get('part') is not None:
+        env.update(EXTRACT_FIRST_PAGE=str(data['first_page']),
+                   EXTRACT_LAST_PAGE=str(data['last_page']))
+    rc = subprocess.call(['/bin/sh', script, data['url'], workdir, pdf], env=env)
+    record_script_timings(workdir)
+    return rc
+
+def record_script_timings(workdir):
+    """Records the step timings the extract script left in workdir.
+       The script runs pages in parallel, so its timings are per document
+       wall clock times, kept apart from the per page timings of the python
+       engine as extract_script_<step>_seconds."""
+    try:
+        with open(path.join(workdir, 'timings')) as f:
+            for line in f:
+                try:
+                    step, seconds = line.split()
+                    metrics.observe('extract_script_%s_seconds' % (step,), float(seconds))
+                except ValueError:
+                    pass
+    except IOError:
+        pass
+
+def pdf_digest(filename):
+    """Returns the sha1 hex digest of the contents of filename"""
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def digest_keyname(digest):
+    """S3 key name under which the extraction of a file with digest is recorded"""
+    return "%s%s.json" % (config('default.digest-prefix', 'sha1/'), digest)
+
+def find_extraction(text_bucket, digest):
+    """Returns the recorded extraction of a file with digest, if any"""
+    if config('default.dedup', 'yes') != 'yes':
+        return None
+
+    key = text_bucket.get_key(digest_keyname(digest))
+    if not key:
+        return None
 
+    try:
+        return json.loads(key.get_contents_as_string())
+    except Exception as e:
+        warn("extract: cannot read extraction record", digest, e)
+        return None
+
+def record_extraction(text_bucket, digest, result):
+    """Records that the file with digest was extracted into result"""
+    if not digest or config('default.dedup', 'yes') != 'yes':
+        return
 
+    try:
+        key = text_bucket.new_key(digest_keyname(digest))
+        key.set_contents_from_string(json.dumps({'fcc_num': result['fcc_num'],
+                                                 'content_key': result['content_key']}))
+    except Exception as e:
+        warn("extract: cannot record extraction", digest, e)
 
-        num = str(data['fcc_num'])
-        keyname = num + ".txt"
+def reuse_extraction(original, result, keyname, text_bucket, image_bucket):
+    """Fills in result from a previous extraction of an identical file.
+       The text is stored again under keyname, with this document's metadata,
+       and page images are copied within S3.
+       Returns False if the previous extraction cannot be used."""
 
-        #TODO: Optimize this by providing a list of keys to each script
-        #      instance. A user-data url to a file would work.
-        #      While it would be simpler to provide the data directly through
-        #      user data, there's a limit on the size of that data.
-        #      See sqlite3 module for an in memory database.
-        #      Probably simplest to use a cache module.
-        #      bonus if it knows how to prime from a disk file.
-        if text_bucket.get_key(keyname):
-            continue
+    orig_num = str(original['fcc_num'])
+
+    try:
+        data, content = load_text(text_bucket, original['content_key'])
+    except Exception as e:
+        warn("extract: cannot load previous extraction", original, e)
+        return False
+
+    if data is None or data.get('status', 'public') != 'public':
+        return False
+
+    for entry in image_bucket.list(prefix=orig_num + '/'):
+        image_bucket.copy_key(result['fcc_num'] + entry.key[len(orig_num):],
+                              image_bucket.name, entry.key)
+
+    pages = data.get('pages', [])
+    result.update(status='public', content_key=keyname, pagecount=len(pages),
+                  duplicate_of=orig_num)
+    if pages:
+        result['pages'] = pages
+
+    store_text(text_bucket, keyname, result, content)
+
+    warn("extract: reused extraction of", orig_num, "for", result['fcc_num'])
+
+    return True
+
+class UploadBatch(object):
+    """A set of uploads that can be waited on together"""
+
+    def __init__(self, count):
+        self.pending = count
+        self.errors = []
+        self.cond = threading.Condition()
+
+    def done(self, keyname, error=None):
+        with self.cond:
+            self.pending -= 1
+            if error:
+                self.errors.append((keyname, error))
+            self.cond.notify_all()
+
+    def wait(self):
+        """Blocks until all uploads are done and returns a list of (keyname, error) pairs"""
+        with self.cond:
+            while self.pending > 0:
+                self.cond.wait(1)
+            return self.errors
+
+class Uploader(object):
+    """A bounded pool of threads that upload files to S3.
+       Each thread keeps its own S3 connection, so HTTP connections are
+       reused across uploads and documents."""
+
+    def __init__(self, threads):
+        self.jobs = Queue.Queue()
+        for i in range(threads):
+            t = threading.Thread(target=self.run)
+            t.daemon = True
+            t.start()
+
+    def run(self):
+        s3_conn = get_s3_connection()
+        buckets = {}
+
+        while True:
+            bucket_name, keyname, filename, batch = self.jobs.get()
+            try:
+                if bucket_name not in buckets:
+                    buckets[bucket_name] = s3_conn.get_bucket(bucket_name, validate=False)
+                with metrics.timer('extract_upload_seconds'):
+                    buckets[bucket_name].new_key(keyname).set_contents_from_filename(filename)
+                metrics.inc('extract_uploads_total')
+            except Exception as e:
+                metrics.inc('extract_upload_errors_total')
+                batch.done(keyname, e)
+            else:
+                batch.done(keyname)
+
+    def upload(self, bucket_name, files):
+        """Queues uploads of files, a list of (keyname, filename) pairs.
+           Returns an UploadBatch to wait on."""
+        batch = UploadBatch(len(files))
+        for keyname, filename in files:
+            self.jobs.put((bucket_name, keyname, filename, batch))
+        return batch
 
-        workdir = tempfile.mkdtemp(prefix="extraction-", suffix='-' + num)
-        script = path.join(path.abspath(path.dirname(sys.argv[0])), 'extract')
-        rc = subprocess.call(['/bin/sh', script, data['url'], workdir])
+UPLOADER = None
+UPLOADER_LOCK = threading.Lock()
 
-        result = {'filing_doc_id': data['filing_doc_id'], 'fcc_num': num }
+def get_uploader():
+    """Returns the process wide uploader, sized by default.upload-threads"""
+    global UPLOADER
+    with UPLOADER_LOCK:
+        if not UPLOADER:
+            UPLOADER = Uploader(int(config('default.upload-threads', 8)))
+    return UPLOADER
+
+def image_uploads(num, workdir, part=None):
+    """Returns a list of (keyname, filename) pairs for the page images in workdir.
+       With default.image-format = packed, the images are first packed into
+       a single file (see imagepack.py), one per part for split documents."""
+
+    images = {}
+    for name in glob.iglob(workdir + '/jpeg/page-*.jpg'):
+
+        m = re.search('page-(\d+).jpg', name)
+        if not m:
+            raise Exception("cannot extract page number from filename: " + name)
+
+        images[int(m.group(1))] = name # force page number to unpadded int.
+
+    if config('default.image-format', 'pages') == 'packed':
+        if not images:
+            return []
+        name = 'pages.pack' if part is None else 'pages-%d.pack' % (part,)
+        pack = path.join(workdir, name)
+        imagepack.pack(images, pack)
+        return [("%s/%s" % (num, name), pack)]
+
+    return [("%s/page-%s.jpg" % (num, number), name) for number, name in images.iteritems()]
+
+def extract_document(data, text_bucket, image_bucket, index=None):
+    """Runs the extraction script for a single document, or a page range
+       of one, and stores the resulting images and text in S3.
+       If index is given, it is used instead of S3 to skip documents that
+       have already been extracted and is updated with the new key.
+       Returns the result dict or None if the document was already extracted."""
+
+    num = str(data['fcc_num'])
+    keyname = num + ".txt"
+
+    part = data.get('part')
+    if part is not None:
+        keyname = part_keyname(num, part)
+
+    if is_extracted(keyname, text_bucket, index):
+        return None
+
+    if part is not None and is_extracted(num + ".txt", text_bucket, index): # already merged
+        return None
+
+    result = {'filing_doc_id': data['filing_doc_id'], 'fcc_num': num }
+
+    tracing.carry(data, result)
+    tracing.mark(result, 'extract_start')
+
+    if part is not None:
+        result.update(part=part, parts=data['parts'], content_key=keyname, pagecount=0)
+
+    workdir = tempfile.mkdtemp(prefix="extraction-", suffix='-' + num)
+    pdf = path.join(workdir, num + '.pdf')
+
+    # Failures to store images or text propagate, so the message is not
+    # deleted until the results are durable.
+    try:
+        try:
+            with metrics.timer('extract_download_seconds'):
+                extraction.download(data['url'], pdf)
+            digest = pdf_digest(pdf)
+        except Exception as e:
+            warn("extract: cannot download", data, e)
+            digest = None
+            rc = 1
+        else:
+            # Identical files are only extracted once. Split documents are
+            # rare enough not to bother.
+            original = part is None and find_extraction(text_bucket, digest)
+            if original and reuse_extraction(original, result, keyname, text_bucket, image_bucket):
+                if index:
+                    index.add(keyname)
+                metrics.inc('extract_duplicates_total')
+                tracing.mark(result, 'extract_end')
+                tracing.mark(result, 'uploaded')
+                return result
+
+            with metrics.timer('extract_run_seconds'):
+                rc = run_extraction(data, workdir, pdf)
+
+        tracing.mark(result, 'extract_end')
 
         if rc != 0:
             result['status'] = 'failed'
+            metrics.inc('extract_failures_total')
+
+            # The collector needs every part before it can merge a document.
+            if part is not None:
+                store_text(text_bucket, keyname, result, '')
+                if index:
+                    index.add(keyname)
         else:
             result['status'] = 'public'
             content = []
             pages = []
             offset = 0
 
-            for name in glob.iglob(workdir + '/jpeg/page-*.jpg'):
-                
-                m = re.search('page-(\d+).jpg', name)
-                if not m:
-                    raise Exception("cannot extract page number from filename: " + name)
-
-                image_key = Key(image_bucket)
-                image_key.key = "%s/page-%s.jpg" % (num, int(m.group(1))) # force page number to unpadded int.
-                image_key.set_contents_from_filename(name)
+            # images upload in the background while the text is read
+            uploads = get_uploader().upload(image_bucket.name, image_uploads(num, workdir, part))
 
             for name in glob.iglob(workdir + '/text/*.txt'):
                 m = re.search('page-(\d+).txt', name)
@@ -197,54 +679,275 @@ def extract(limit=None, queue_results=True):
 
                 offset += size
                 f.close()
-           
-            if len(pages):
 
-                text_bucket = s3_conn.get_bucket(config('default.text-bucket'), validate=False)
-                content_key = text_bucket.new_key(keyname)
+            # The text key marks the document as done, so it goes last.
+            with metrics.timer('extract_upload_wait_seconds'):
+                errors = uploads.wait()
+            if errors:
+                raise Exception("failed to upload images: %s" % (errors,))
 
+            if len(pages) or part is not None:
                 result.update(content_key=keyname, pagecount=len(pages))
+                if len(pages):
+                    result['pages'] = pages
+                store_text(text_bucket, keyname, result, ''.join(content))
 
-                for name, value in result.iteritems():
-                    content_key.set_metadata(name, str(value))
+                if index:
+                    index.add(keyname)
 
-                for idx, page in enumerate(pages):
-                    for name, value in page.iteritems():
-                        content_key.set_metadata('page.%d.%s' % (idx, name), str(value))
+                if part is None and len(pages):
+                    record_extraction(text_bucket, digest, result)
 
-                result['pages'] = pages
-                content_str = ''.join(content)
+            metrics.inc('extract_documents_total')
+            metrics.inc('extract_pages_total', len(pages))
 
+        tracing.mark(result, 'uploaded')
+    finally:
+        shutil.rmtree(workdir, True)
+
+    return result
+
+class MessageLeases(object):
+    """Tracks SQS messages that are being worked on.
+
+       A background thread extends the visibility timeout of active messages
+       so they do not reappear on the queue while their document is still
+       being processed, and deletes finished messages in batches.
+       Messages that are released without being finished are left to
+       time out and will be delivered again, possibly to another node."""
+
+    def __init__(self, queue_name, timeout):
+        self.queue_name = queue_name
+        self.timeout = int(timeout)
+        self.active = {}
+        self.finished = []
+        self.cond = threading.Condition()
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def add(self, msg):
+        with self.cond:
+            self.active[msg.receipt_handle] = msg
+
+    def finish(self, msg):
+        """Marks msg as durably processed so it can be deleted"""
+        with self.cond:
+            self.active.pop(msg.receipt_handle, None)
+            self.finished.append(msg)
+            self.cond.notify_all()
+
+    def release(self, msg):
+        """Stops extending msg so it becomes visible again after its timeout"""
+        with self.cond:
+            self.active.pop(msg.receipt_handle, None)
+            self.cond.notify_all()
+
+    def wait_for_capacity(self, slots):
+        """Blocks until fewer than slots messages are active and returns the
+           number of free slots"""
+        with self.cond:
+            while len(self.active) >= slots:
+                self.cond.wait(1)
+            return slots - len(self.active)
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        self.thread.join()
+
+    def run(self):
+        sqs_conn = get_sqs_connection()
+        queue = get_queue(sqs_conn, self.queue_name)
+
+        # Extend well before the timeout expires.
+        interval = max(self.timeout / 3, 1)
+        last_extended = time.time()
+
+        while True:
+            with self.cond:
+                if not self.stopping and not self.finished:
+                    self.cond.wait(max(interval - (time.time() - last_extended), 0.1))
+
+                stopping = self.stopping
+                finished, self.finished = self.finished, []
+
+                if time.time() - last_extended >= interval:
+                    active = self.active.values()
+                    last_extended = time.time()
+                else:
+                    active = []
+
+            for i in range(0, len(finished), SQS_BATCH_SIZE):
                 try:
-                    content_key.set_contents_from_string(content_str)
-                except boto.exception.S3ResponseError as e:
-                        try:
-                            metadata = text_bucket.new_key("%s.meta" % (data['fcc_num'],))
-                            metadata.set_contents_from_string(json.dumps(result))
-                        except Exception as e:
-                            warn("Failed to store metadata", e)
-                        else:
-                            try:
-                                content_key = text_bucket.new_key(keyname)
-                                content_key.set_metadata('metadata', metadata.key)
-                                content_key.set_contents_from_string(content_str)
-                            except Exception as e:
-                                warn("failed to store text (again!)", data, e)
+                    sqs_conn.delete_message_batch(queue, finished[i:i + SQS_BATCH_SIZE])
                 except Exception as e:
-                   warn("unhandled error #2", e)
+                    warn("extract: cannot delete messages", e)
 
-        warn("extract output", result)
+            for i in range(0, len(active), SQS_BATCH_SIZE):
+                try:
+                    sqs_conn.change_message_visibility_batch(queue,
+                        [(msg, self.timeout) for msg in active[i:i + SQS_BATCH_SIZE]])
+                except Exception as e:
+                    warn("extract: cannot extend message visibility", e)
 
-        if queue_results:
-            out_queue.write(dict_to_msg(result))
-        
-        shutil.rmtree(workdir, True)
+            if stopping:
+                break
+
+def get_key_index():
+    """Returns the local extracted key index named by default.key-index
+       in config, or None if there isn't one."""
+    filename = config('default.key-index', None)
+    if filename:
+        return keyindex.KeyIndex(filename)
+    return None
+
+def prime_index(snapshot=None):
+    """Primes the local key index from a snapshot file, one key per line,
+       or, if none is given, from a listing of the text bucket."""
+    index = get_key_index()
+    if not index:
+        raise Exception("default.key-index is not set in config")
+
+    if snapshot:
+        count = index.prime_from_file(snapshot)
+    else:
+        text_bucket = get_s3_connection().get_bucket(config('default.text-bucket'), validate=False)
+        count = index.prime_from_bucket(text_bucket)
+
+    warn("prime_index: added", count, "keys")
+    index.close()
+
+def extract_worker(jobs, leases, queue_results, index=None):
+    """Extraction slot. Processes (data, message) pairs from the jobs queue
+       until it receives None. Each slot has its own connections since boto
+       connections are not thread safe. The message is only finished, and so
+       deleted, once the results are stored in S3 and queued."""
+
+    if queue_results:
+        out_queue = get_queue(get_sqs_connection(), config('default.collector-queue'))
+
+    s3_conn = get_s3_connection()
+    text_bucket = s3_conn.get_bucket(config('default.text-bucket'), validate=False)
+    image_bucket = s3_conn.get_bucket(config('default.image-bucket'), validate=False)
 
-        counter += 1
-        if limit and counter == int(limit):
+    while True:
+        job = jobs.get()
+        if job is None:
+            jobs.task_done()
             break
 
-   
+        data, msg = job
+
+        try:
+            result = extract_document(data, text_bucket, image_bucket, index)
+
+            if result:
+                warn("extract output", result)
+                if queue_results:
+                    out_queue.write(dict_to_msg(result))
+        except Exception as e:
+            warn("extract: error processing", data, e)
+            leases.release(msg)
+        else:
+            leases.finish(msg)
+
+        jobs.task_done()
+
+def extract(limit=None, queue_results=True, slots=None, until_empty=False):
+    """Extract texts of pdf files specified in queue.
+       Result files are placed in S3, along with associated metadata.
+       If queue_results is is true, result data is placed on the output queue.
+       Up to slots documents (default.extract-slots in config) are processed
+       concurrently so that downloads, OCR and uploads of different
+       documents overlap.
+
+       Messages are long polled, in batches, and are kept invisible
+       while their document is processed. They are deleted only after the
+       results are stored so work held by a node that dies is picked up
+       elsewhere once default.extract-visibility-timeout seconds pass.
+
+       If until_empty is true, it stops once a receive finds the queue empty.
+
+       This part can run on EC2 instances or the local machine if it has been
+       configured."""
+
+    # the OCR pool forks, so it is started before any thread is.
+    if config('default.extract-engine', 'script') == 'python':
+        extraction.get_pool()
+
+    queue_name = config('default.injector-queue')
+    sqs_conn = get_sqs_connection()
+    in_queue = get_queue(sqs_conn, queue_name)
+
+    if slots is None:
+        slots = config('default.extract-slots', 1)
+    slots = max(int(slots), 1)
+
+    timeout = int(config('default.extract-visibility-timeout', 300))
+    wait_time = int(config('default.receive-wait-time', 20))
+
+    leases = MessageLeases(queue_name, timeout)
+    leases.start()
+
+    index = get_key_index()
+
+    jobs = Queue.Queue()
+
+    threads = []
+    for i in range(slots):
+        t = threading.Thread(target=extract_worker, args=(jobs, leases, queue_results, index))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    counter = 0
+    if limit:
+        limit = int(limit)
+
+    try:
+        while not (limit and counter >= limit):
+            wanted = min(leases.wait_for_capacity(slots), SQS_BATCH_SIZE)
+            if limit:
+                wanted = min(wanted, limit - counter)
+
+            messages = in_queue.get_messages(num_messages=wanted,
+                                             visibility_timeout=timeout,
+                                             wait_time_seconds=wait_time)
+
+            if until_empty and not messages:
+                break
+
+            for msg in messages:
+                try:
+                    data = msg_to_dict(msg)
+                    tracing.mark(data, 'dequeued')
+                    warn("extract: input", data)
+                except:
+                    warn("cannot extract data from", msg.get_body())
+                    leases.finish(msg)
+                    continue
+
+                leases.add(msg)
+                jobs.put((data, msg))
+
+                counter += 1
+    finally:
+        for t in threads:
+            jobs.put(None)
+
+        for t in threads:
+            t.join()
+
+        leases.stop()
+
+        if index:
+            index.close()
+
 def extract_batch(limit=None):
     """Extracts data without placing results in sqs"""
     extract(limit=limit, queue_results=False)
@@ -253,19 +956,24 @@ def extract_online(limit=None):
     """Extracts data and places result data in queue"""
     extract(limit=limit, queue_results=True)
 
-def update_document(data, content=None):
-    """updates database with extracted data."""
+def update_document(data, content=None, commit=True, check_status=True):
+    """updates database with extracted data.
+       All pages of the document are inserted with multi-row INSERTs.
+       If commit is false, the caller is responsible for committing.
+       If check_status is false, the caller has already made sure that
+       the document is not public."""
 
     conn = db.connection()
     cur = conn.cursor()
 
     filing_doc_id = data['filing_doc_id']
 
-    cur.execute("select id from filing_docs where id = %s and status = 'public'",
-                (filing_doc_id,))
+    if check_status:
+        cur.execute("select id from filing_docs where id = %s and status = 'public'",
+                    (filing_doc_id,))
 
-    if cur.rowcount == 1:
-        return
+        if cur.rowcount == 1:
+            return
 
     if data.get('status', 'public') == 'public':
         #TODO: avoid doing repeated work. Probably easiest to ignore
@@ -286,153 +994,654 @@ def update_document(data, content=None):
             cur.execute("delete from doc_pages where filing_doc_id = %s",
                     (filing_doc_id,))
 
+            columns = ('filing_doc_id', 'pagenumber', 'pagetext', 'wordcount')
+
+            # the search vectors are filled in by a trigger (see searchindex.py)
+            rows = []
             for page in data['pages']:
                 offset, size = int(page['offset']), int(page['size'])
                 pagetext = content[offset:offset+size]
                 wordcount = len(pagetext.split(' ')) #roughly
-                record = dict(filing_doc_id=filing_doc_id,
-                      pagenumber=page['number'],
-                      pagetext=pagetext,
-                      wordcount=wordcount)
+                rows.append((filing_doc_id, page['number'], pagetext, wordcount))
 
-                cur.execute(*db.dict_to_sql_insert('doc_pages', record))
+            db.insert_many(cur, 'doc_pages', columns, rows)
     else:
         cur.execute("update filing_docs set status = 'failed' where id = %s", (filing_doc_id,))
 
     if VERBOSE:
         warn("updated", data)
 
-    conn.commit()
-        
-def collect(limit=None):
-    """Collect extraction results from queue and S3 and stores them in database.
-       This part runs on the local machine."""
+    if commit:
+        conn.commit()
+
+class DocumentWriter(object):
+    """Groups document updates into larger transactions.
+
+       Documents are written as they arrive, each inside its own savepoint so a
+       bad document does not spoil the rest, and the transaction is committed
+       once batch_size documents are pending or commit_interval seconds have
+       passed since the last commit. Each write may carry a token, such as an
+       SQS message; commit returns the tokens of the documents it made durable
+       and records their traces (see tracing.py). If failed is given, it is
+       called with the token of each document that cannot be written."""
+
+    def __init__(self, batch_size=None, commit_interval=None, failed=None):
+        if batch_size is None:
+            batch_size = config('default.collect-batch-size', 50)
+        if commit_interval is None:
+            commit_interval = config('default.collect-commit-interval', 10)
+
+        self.batch_size = max(int(batch_size), 1)
+        self.commit_interval = float(commit_interval)
+        self.failed = failed
+        self.pending = []
+        self.traced = []
+        self.last_commit = time.time()
+
+    def write(self, data, content=None, token=None, check_status=True):
+        """Writes a document. Returns the committed tokens if this write
+           caused a commit, otherwise an empty list. The token of a document
+           that cannot be written is never returned, so its message comes
+           back once its visibility timeout expires."""
+
+        try:
+            cur = db.connection().cursor()
+            cur.execute("SAVEPOINT document")
+            try:
+                with metrics.timer('collect_db_write_seconds'):
+                    update_document(data, content, commit=False, check_status=check_status)
+            except db.CONNECTION_ERRORS:
+                raise
+            except Exception as e:
+                cur.execute("ROLLBACK TO SAVEPOINT document")
+                metrics.inc('collect_write_errors_total')
+                warn("cannot update document", data.get('filing_doc_id'), e)
+                if self.failed:
+                    self.failed(token)
+                return []
+            else:
+                cur.execute("RELEASE SAVEPOINT document")
+                metrics.inc('collect_documents_total')
+                metrics.inc('collect_pages_total', len(data.get('pages', [])))
+                if 'trace' in data:
+                    self.traced.append(data)
+        except db.CONNECTION_ERRORS as e:
+            self.lost(e)
+            return []
+
+        self.pending.append(token)
+
+        if self.due():
+            return self.commit()
+
+        return []
+
+    def due(self):
+        """Tells whether pending documents should be committed"""
+        return len(self.pending) >= self.batch_size or \
+            (self.pending and time.time() - self.last_commit >= self.commit_interval)
+
+    def lost(self, error):
+        """Drops pending documents after the connection is lost.
+           Their tokens are never returned, so their messages are redelivered."""
+        warn("lost database connection, dropping %d pending documents:" % (len(self.pending),), error)
+        db.discard()
+        metrics.inc('collect_lost_documents_total', len(self.pending))
+        self.pending = []
+        self.traced = []
+        self.last_commit = time.time()
+
+    def commit(self):
+        """Commits pending documents and returns their tokens"""
+        try:
+            with metrics.timer('collect_db_commit_seconds'):
+                db.connection().commit()
+        except db.CONNECTION_ERRORS as e:
+            self.lost(e)
+            return []
+
+        self.last_commit = time.time()
+
+        traced, self.traced = self.traced, []
+        tracing.record(traced, self.last_commit)
+
+        tokens, self.pending = self.pending, []
+        return [token for token in tokens if token is not None]
+
+def merge_parts(bucket, data):
+    """Assembles the text and page index of a split document once all of its
+       parts are in S3. The merged text is stored under the document's own key.
+       The parts are left in place; the collector removes them with
+       delete_parts once the merged document is committed, so a redelivered
+       message can merge them again.
+       Returns the merged data and content or (None, None) if parts are missing."""
+
+    num = str(data['fcc_num'])
+    parts = int(data['parts'])
+
+    # every part's message gets here, so a single listing tells whether all
+    # of them are in before any text is read.
+    stored = set(key.name for key in bucket.list(prefix=num + '.part-'))
+    if any(part_keyname(num, part) not in stored for part in range(parts)):
+        return None, None
+
+    loaded = []
+    for part in range(parts):
+        part_data, part_content = load_text(bucket, part_keyname(num, part))
+        if part_data is None:
+            return None, None
+        loaded.append((part_data, part_content))
+
+    merged = {'filing_doc_id': data['filing_doc_id'], 'fcc_num': num}
+
+    if any(part_data.get('status') == 'failed' for part_data, _ in loaded):
+        merged['status'] = 'failed'
+    else:
+        content = []
+        pages = []
+        offset = 0
+
+        for part_data, part_content in loaded:
+            for page in part_data.get('pages', []):
+                size = int(page['size'])
+                start = int(page['offset'])
+                pages.append({'number': page['number'], 'size': size, 'offset': offset})
+                content.append(part_content[start:start + size])
+                offset += size
+
+        keyname = num + ".txt"
+        merged.update(status='public', content_key=keyname, pagecount=len(pages))
+        if pages:
+            merged['pages'] = pages
+
+        content = ''.join(content)
+        store_text(bucket, keyname, merged, content)
+
+    if merged['status'] == 'failed':
+        return merged, None
+
+    return merged, content
+
+def delete_parts(bucket, fcc_num, parts):
+    """Removes the part keys of a merged document"""
+    keynames = []
+    for part in range(int(parts)):
+        keyname = part_keyname(fcc_num, part)
+        keynames.extend([keyname, re.sub('\.txt$', '', keyname) + '.meta'])
+    try:
+        bucket.delete_keys(keynames, quiet=True)
+    except Exception as e:
+        warn("cannot delete parts of", fcc_num, e)
+
+def delete_messages(sqs_conn, queue, messages):
+    """Deletes messages from queue in batches"""
+    for i in range(0, len(messages), SQS_BATCH_SIZE):
+        try:
+            sqs_conn.delete_message_batch(queue, messages[i:i + SQS_BATCH_SIZE])
+        except Exception as e:
+            warn("cannot delete messages", e)
+
+def collect_receiver(received, fetchers, stop, limit=None, until_empty=False):
+    """Collector stage one. Long polls the collector queue for batches of
+       messages and hands them to the fetchers until stop is set, limit
+       messages have been received or, if until_empty is true, a receive
+       finds the queue empty."""
 
     sqs_conn = get_sqs_connection()
     queue = get_queue(sqs_conn, config('default.collector-queue'))
+    timeout = int(config('default.collect-visibility-timeout', 300))
+    wait_time = int(config('default.receive-wait-time', 20))
 
-    s3_conn = get_s3_connection()
+    count = 0
+    try:
+        while not stop.is_set() and not (limit and count >= limit):
+            wanted = SQS_BATCH_SIZE
+            if limit:
+                wanted = min(wanted, limit - count)
+
+            try:
+                messages = queue.get_messages(num_messages=wanted,
+                                              visibility_timeout=timeout,
+                                              wait_time_seconds=wait_time)
+            except Exception as e:
+                warn("collect: receive failed", e)
+                time.sleep(wait_time)
+                continue
+
+            if until_empty and not messages:
+                break
+
+            for msg in messages:
+                received.put(msg)
+                count += 1
+    finally:
+        for i in range(fetchers):
+            received.put(None)
+
+def collect_fetcher(received, fetched):
+    """Collector stage two. Fetches the text of each received result from S3.
+       Puts (message, data, content, parts) on fetched. data is None for
+       messages that only need deleting. parts is (fcc_num, number of parts)
+       for merged documents, whose parts are deleted after the commit."""
+
+    bucket_name = config('default.text-bucket')
+    bucket = get_s3_connection().lookup(bucket_name, validate=False)
+
+    while True:
+        msg = received.get()
+        if msg is None:
+            break
+
+        try:
+            data = msg_to_dict(msg)
+        except Exception:
+            data = None
+
+        if not isinstance(data, dict):
+            warn("sqs msg is not in json format")
+            fetched.put((msg, None, None, None))
+            continue
+
+        warn("process: got data", data)
+        tracing.mark(data, 'collect_received')
+
+        start = time.time()
+        parts = None
+        try:
+            if 'parts' in data:
+                part_data = data
+                data, content = merge_parts(bucket, data)
+                if data:
+                    tracing.carry(part_data, data)
+                    parts = (part_data['fcc_num'], part_data['parts'])
+            elif data.get('status') != 'public':
+                content = None
+            else:
+                stored, content = load_text(bucket, data['content_key'])
+                if stored is None:
+                    raise Exception("missing key " + data['content_key'])
+
+                # compact objects carry their own page index
+                if 'pages' in stored:
+                    data['pages'] = stored['pages']
+        except Exception as e:
+            metrics.inc('collect_fetch_errors_total')
+            warn("cannot get extracted S3 text for:", data, e)
+            if parts is None and 'parts' in data:
+                # the parts are still there, so let the message come back
+                # once its visibility timeout expires and merge again.
+                continue
+            data = content = None
+        else:
+            metrics.observe('collect_fetch_seconds', time.time() - start)
+
+        fetched.put((msg, data, content, parts))
+
+    fetched.put(None)
+
+def collect(limit=None, until_empty=False):
+    """Collect extraction results from queue and S3 and stores them in database.
+       This part runs on the local machine.
+
+       The collector is a pipeline of three stages joined by bounded queues:
+       a receiver that long polls for batches of messages, a pool of
+       default.collect-fetchers threads that fetch the texts from S3, and
+       this thread, which writes documents to the database in batches
+       (see DocumentWriter) and deletes messages once they are committed.
+       It runs until limit messages are processed, the queue is found empty
+       if until_empty is true, or it receives SIGINT or SIGTERM, then drains
+       the pipeline and exits."""
 
     bucket_name = config('default.text-bucket')
-    bucket = s3_conn.lookup(bucket_name, validate=False)
+    bucket = get_s3_connection().lookup(bucket_name, validate=False)
     if not bucket:
         raise Exception("Bucket %s does not exist. Please create it!" % (bucket_name,))
 
+    sqs_conn = get_sqs_connection()
+    queue = get_queue(sqs_conn, config('default.collector-queue'))
+
     if limit:
         limit = int(limit)
 
-    msgcount = 0
-    process_queue = True
+    fetchers = max(int(config('default.collect-fetchers', 4)), 1)
+    depth = int(config('default.collect-queue-depth', 50))
 
-    while process_queue:
-        for msg in sqs_conn.receive_message(queue):
-            data = msg_to_dict(msg)
-            if not isinstance(data, dict):
-                warn("sqs msg is not in json format")
-                continue
-            else:
-                warn("process: got data", data) 
+    received = Queue.Queue(maxsize=depth)
+    fetched = Queue.Queue(maxsize=depth)
+    stop = threading.Event()
 
-            status = data.get('status')
-            if status != 'public':
-                update_document(data)
-                sqs_conn.delete_message(queue, msg)
-                continue
-           
-            try:
-                key_value = data['content_key']
-            except KeyError:
-                warn("cannot get content_key value for data", data)
-                sqs_conn.delete_message(queue, msg)
-                continue
+    def shutdown(signum, frame):
+        warn("collect: shutting down")
+        stop.set()
 
-            content_key = Key(bucket)
-            content_key.key = key_value 
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
 
-            try:
-                content = content_key.get_contents_as_string()
-            except:
-                warn("cannot get extracted S3 text for:", data)
-                sqs_conn.delete_message(queue, msg)
-                continue
+    threads = [threading.Thread(target=collect_receiver, args=(received, fetchers, stop, limit, until_empty))]
+    for i in range(fetchers):
+        threads.append(threading.Thread(target=collect_fetcher, args=(received, fetched)))
+
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    def committed(tokens):
+        # tokens are (message, parts) pairs of committed documents
+        delete_messages(sqs_conn, queue, [msg for msg, parts in tokens])
+        for msg, parts in tokens:
+            if parts:
+                delete_parts(bucket, *parts)
 
-            update_document(data, content)
-            #content_key.delete()
+    writer = DocumentWriter()
+    running = fetchers
+
+    while running:
+        try:
+            item = fetched.get(timeout=1)
+        except Queue.Empty:
+            if writer.due():
+                committed(writer.commit())
+            continue
+
+        if item is None:
+            running -= 1
+            continue
+
+        msg, data, content, parts = item
+        if data is None:
             sqs_conn.delete_message(queue, msg)
-            
-            msgcount += 1
-            if limit and msgcount == limit:
-                process_queue = False
+        else:
+            committed(writer.write(data, content, (msg, parts)))
+
+    committed(writer.commit())
+
+    for t in threads:
+        t.join()
+
+class Checkpoint(object):
+    """Resume markers for collect_batch, one per key prefix, kept in a JSON file.
+
+       Listed keys are registered in pages. A prefix's marker only moves past
+       a page once each of its keys, and of the keys of every page before it,
+       has been committed or recorded as failed, so a restarted run never
+       skips uncommitted work. Failed keys are kept in the file too, until a
+       later run collects them."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.pages = {}     # prefix -> {seq: [last_key, pending]}
+        self.next_seq = {}  # prefix -> lowest page not yet passed by the marker
+
+        try:
+            with open(filename) as f:
+                state = json.load(f)
+        except IOError:
+            state = {}
+
+        # earlier state files hold only the markers
+        if 'markers' not in state:
+            state = {'markers': state}
+
+        self.markers = state['markers']
+        self.failed = set(state.get('failed', []))
+
+    def marker(self, prefix):
+        return self.markers.get(prefix, '')
+
+    def register(self, prefix, seq, last_key, pending):
+        with self.lock:
+            self.pages.setdefault(prefix, {})[seq] = [last_key, pending]
+            self.next_seq.setdefault(prefix, 0)
+            self._advance(prefix)
+
+    def done(self, prefix, seq, key=None):
+        """Records that key, listed in page seq of prefix, has been committed.
+           prefix and seq are None for keys retried from an earlier run."""
+        with self.lock:
+            self.failed.discard(key)
+            if prefix is not None:
+                self.pages[prefix][seq][1] -= 1
+                self._advance(prefix)
+
+    def fail(self, prefix, seq, key):
+        """Records that key could not be collected, so that its page can be
+           passed and the key retried by the next run"""
+        with self.lock:
+            self.failed.add(key)
+            if prefix is not None:
+                self.pages[prefix][seq][1] -= 1
+                self._advance(prefix)
+
+    def _advance(self, prefix):
+        pages = self.pages[prefix]
+        seq = self.next_seq[prefix]
+        while seq in pages and pages[seq][1] == 0:
+            self.markers[prefix] = pages.pop(seq)[0]
+            seq += 1
+        self.next_seq[prefix] = seq
+
+    def save(self):
+        with self.lock:
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'markers': self.markers, 'failed': sorted(self.failed)}, f)
+            os.rename(tmp, self.filename)
+
+def reconcile_lister(prefixes, fetch, checkpoint, bucket_name, stop):
+    """collect_batch lister. Lists the text keys under each prefix, in pages,
+       and queues those whose documents are not yet public in the database.
+       Existence is checked with one query per page."""
+
+    bucket = get_s3_connection().lookup(bucket_name, validate=False)
+    cur = db.connection().cursor()
+    page_size = int(config('default.reconcile-page-size', 1000))
+
+    while not stop.is_set():
+        try:
+            prefix = prefixes.get_nowait()
+        except Queue.Empty:
+            break
+
+        seq = 0
+        keys = []
+        for entry in bucket.list(prefix=prefix, marker=checkpoint.marker(prefix)):
+            keys.append(entry.key)
+            if len(keys) == page_size:
+                reconcile_page(prefix, seq, keys, cur, fetch, checkpoint)
+                seq += 1
+                keys = []
+            if stop.is_set():
                 break
 
-        else: # for loop
-            # no more messages.
-            # wait a while then exit.
-            # so the program can be restarted
-            time.sleep(30 * 60) 
-            process_queue = False
+        if keys and not stop.is_set():
+            reconcile_page(prefix, seq, keys, cur, fetch, checkpoint)
+
+    db.release()
+
+def reconcile_page(prefix, seq, keys, cur, fetch, checkpoint):
+    """Registers a page of listed keys and queues the ones that need collecting"""
+
+    # parts are merged by collect
+    candidates = dict((key[:-len('.txt')], key) for key in keys
+                      if key.endswith('.txt') and '.part-' not in key)
+
+    missing = []
+    if candidates:
+        cur.execute("SELECT fcc_num FROM filing_docs WHERE status <> 'public' AND fcc_num = ANY(%s)",
+                    (candidates.keys(),))
+        missing = [candidates[row[0]] for row in cur.fetchall()]
+        cur.connection.commit()
+
+    checkpoint.register(prefix, seq, keys[-1], len(missing))
+
+    for key in missing:
+        fetch.put((prefix, seq, key))
+
+def reconcile_fetcher(fetch, fetched, bucket_name):
+    """collect_batch fetcher. Loads the text of queued keys from S3."""
+
+    bucket = get_s3_connection().lookup(bucket_name, validate=False)
+
+    while True:
+        item = fetch.get()
+        if item is None:
+            break
+
+        prefix, seq, key = item
+        try:
+            with metrics.timer('collect_fetch_seconds'):
+                data, content = load_text(bucket, key)
+        except Exception as e:
+            metrics.inc('collect_fetch_errors_total')
+            warn("cannot fetch text", key, e)
+            data = content = None
+
+        fetched.put(((prefix, seq, key), data, content))
+
+    fetched.put(None)
 
 def collect_batch(limit=None):
-    """Collects completed jobs from S3 and updates database. Needs to avoid repeated work."""
+    """Collects completed jobs from S3 and updates database.
 
-    s3_conn = get_s3_connection()
+       Rebuilds the database from the text bucket. Keys are listed by prefix
+       (default.reconcile-prefixes, 00 to 99 by default) across
+       default.reconcile-listers threads. Each page of keys is checked against
+       filing_docs in a single query, and only the documents that are not
+       public yet are fetched, by default.reconcile-fetchers threads, and
+       written in batches.
+
+       Progress is saved in default.reconcile-state (reconcile-state.json)
+       so an interrupted run resumes where it left off. Keys that cannot be
+       fetched or written are saved there too and retried first by the next
+       run. Remove the file to start over."""
 
     bucket_name = config('default.text-bucket')
-    bucket = s3_conn.lookup(bucket_name, validate=False)
-  
-    if not bucket:
+    if not get_s3_connection().lookup(bucket_name, validate=False):
         raise Exception("Bucket %s does not exist. Please create it!" % (bucket_name,))
 
     if limit:
         limit = int(limit)
 
+    checkpoint = Checkpoint(config('default.reconcile-state', 'reconcile-state.json'))
+
+    prefixes = Queue.Queue()
+    # document numbers share their leading digits, so two of them are needed
+    # to spread the listing across the listers.
+    default_prefixes = ' '.join('%02d' % (i,) for i in range(100))
+    for prefix in config('default.reconcile-prefixes', default_prefixes).split():
+        prefixes.put(prefix)
+
+    listers = max(int(config('default.reconcile-listers', 4)), 1)
+    fetchers = max(int(config('default.reconcile-fetchers', 8)), 1)
+    depth = int(config('default.collect-queue-depth', 50))
+
+    fetch = Queue.Queue(maxsize=depth)
+    fetched = Queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    lister_threads = [threading.Thread(target=reconcile_lister,
+                                       args=(prefixes, fetch, checkpoint, bucket_name, stop))
+                      for i in range(listers)]
+    fetcher_threads = [threading.Thread(target=reconcile_fetcher, args=(fetch, fetched, bucket_name))
+                       for i in range(fetchers)]
+
+    for t in lister_threads + fetcher_threads:
+        t.daemon = True
+        t.start()
+
+    retries = sorted(checkpoint.failed)
+
+    def end_listing():
+        for key in retries:
+            fetch.put((None, None, key))
+        for t in lister_threads:
+            t.join()
+        for t in fetcher_threads:
+            fetch.put(None)
+
+    ender = threading.Thread(target=end_listing)
+    ender.daemon = True
+    ender.start()
+
+    def committed(tokens):
+        for prefix, seq, key in tokens:
+            checkpoint.done(prefix, seq, key)
+        if tokens:
+            checkpoint.save()
+
+    def failed(token):
+        checkpoint.fail(*token)
+
+    writer = DocumentWriter(failed=failed)
+    running = fetchers
     counter = 0
 
-    for entry in bucket.list():
-        
-        if entry.key.endswith('.meta'):
-            continue
+    try:
+        while running:
+            try:
+                item = fetched.get(timeout=1)
+            except Queue.Empty:
+                if writer.due():
+                    committed(writer.commit())
+                continue
 
-        if limit:
-            counter += 1
-            if counter > limit:
-                break
+            if item is None:
+                running -= 1
+                continue
 
-        key = bucket.get_key(entry.key) # must do a HEAD request to get metadata
+            token, data, content = item
+            if data is None:
+                failed(token)
+                continue
 
-        metadata_key = key.get_metadata('metadata')
+            # listing already established that the document is not public,
+            # but a retried key may have been collected since it failed
+            committed(writer.write(data, content, token, check_status=token[0] is None))
 
-        if metadata_key:
-            o = bucket.new_key(metadata_key)
-            try:
-                data = json.loads(o.get_contents_as_string())
-            except Exception as e:
-                warn("cannot fetch metadata", metadata_key, e)
-                continue
-            else:
-                if not data.get('pagecount'):
-                    data['pagecount'] = len(data.get('pages', []))
-        else:
-            data = {}
-            for name in ('filing_doc_id', 'fcc_num', 'pagecount'):
-                data[name] = key.get_metadata(name)
-       
-            try:
-                data['pagecount'] = int(data['pagecount'])
-            except:
-                data['pagecount'] = 0
+            counter += 1
+            if limit and counter >= limit:
+                break
+    finally:
+        stop.set()
+        committed(writer.commit())
+        checkpoint.save()
 
-            pages = []
-            for idx in range(data['pagecount']):
-                page = {}
-                for name in ('number', 'size', 'offset'):
-                    page[name] = key.get_metadata('page.%d.%s' % (idx, name))
-                pages.append(page)
-
-            if len(pages):
-                data['pages'] = pages
-       
-        update_document(data, key.get_contents_as_string())
+    searchindex.notify(db.connection())
+
+def local_worker(number):
+    """process_local worker process body"""
+    metrics.PROCESS = 'task-extract-%d' % (number,)
+    try:
+        extract(until_empty=True)
+    finally:
+        # worker processes end without running exit handlers
+        metrics.flush()
+
+def process_local(workers=None):
+    """Runs the whole pipeline on this machine with the local backend:
+       injects new documents, extracts them with a pool of workers
+       (default.local-workers processes, one per cpu by default), each with
+       default.extract-slots slots, then collects the results.
+       Each stage runs until its queue is empty."""
+
+    if not is_local():
+        raise Exception("process_local requires default.backend = local in config")
+
+    if workers is None:
+        workers = config('default.local-workers', multiprocessing.cpu_count())
+    workers = max(int(workers), 1)
+
+    inject()
+
+    # the workers do not use the database, so none of its connections is shared.
+    processes = [multiprocessing.Process(target=local_worker, args=(i,)) for i in range(workers)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+
+    collect(until_empty=True)
 
 if __name__ == "__main__":
     import sys
@@ -0,0 +1,114 @@
+import unittest
+
+import comment
+import db
+import metrics
+
+
+class Connection(object):
+
+    def __init__(self):
+        self.commits = 0
+
+    def cursor(self):
+        return None
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        pass
+
+
+class CommentBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (db.connection, db.insert_many, comment.parse_comment,
+                      comment.import_comment, metrics.REGISTRY)
+        self.conn = Connection()
+        self.inserts = []
+        self.imported = []
+        self.parsed = {}
+        db.connection = lambda: self.conn
+        db.insert_many = self.insert_many
+        comment.parse_comment = lambda url, content=None: self.parsed[url]
+        comment.import_comment = lambda proceeding_id, url, content=None: self.imported.append(url)
+        metrics.REGISTRY = False
+
+    def tearDown(self):
+        (db.connection, db.insert_many, comment.parse_comment,
+         comment.import_comment, metrics.REGISTRY) = self.saved
+
+    def insert_many(self, cur, tablename, columns, rows, template=None, page_size=500, suffix=''):
+        self.inserts.append((tablename, columns, rows))
+        if tablename == 'filings':
+            # the database returns fcc_num in its own type
+            idx = columns.index('fcc_num')
+            return [(100 + i, int(row[idx])) for i, row in enumerate(rows)]
+        return []
+
+    def test_links_documents_to_new_filings(self):
+        self.parsed['a'] = ({'fcc_num': '6017456789'}, [{'url': 'doc-a'}])
+        batch = comment.CommentBatch()
+        batch.add(7, 'a')
+        batch.flush()
+
+        docs = [insert for insert in self.inserts if insert[0] == 'filing_docs']
+        self.assertEqual(docs, [('filing_docs', ('filing_id', 'url'), [(100, 'doc-a')])])
+        self.assertEqual(self.conn.commits, 1)
+
+    def test_imports_comments_without_number_one_at_a_time(self):
+        self.parsed['b'] = ({}, [{'url': 'doc-b'}])
+        batch = comment.CommentBatch()
+        batch.add(7, 'b')
+        batch.flush()
+
+        self.assertEqual(self.imported, ['b'])
+        self.assertEqual(self.inserts, [])
+
+
+PAGE = """<html><head><meta http-equiv="Content-Type" content="text/html; charset=iso-8859-1">
+<title>ECFS</title></head><body><div id="menu"><div>menu</div></div>
+<div id="data">
+<div class="wwgrp"><span><label class="label">Name of Filer:</label></span><span>Caf\xe9 Owners</span></div>
+<div class="wwgrp"><span><label class="label">Type of Filing:</label></span><span>COMMENT</span></div>
+<div class="wwgrp"><span><label class="label">View Filing:</label></span><span><div class="links"><div>
+<a href="/ecfs/document/view?id=7521094325">View (12)</a></div></div></span></div>
+</div>
+<div id="footer">footer</div></body></html>"""
+
+
+class DataSectionTest(unittest.TestCase):
+
+    def test_section_ends_after_nested_divs(self):
+        section = comment.data_section(PAGE)
+        self.assertIn('View (12)</a></div></div></span></div></body>', section)
+        self.assertNotIn('footer', section)
+        self.assertNotIn('menu', section)
+        self.assertIn('charset=iso-8859-1', section)
+
+    def test_section_is_parsed_like_the_page(self):
+        url = 'http://apps.fcc.gov/ecfs/comment/view?id=6017456789'
+        self.assertEqual(comment.parse_comment(url, PAGE, section_only=True),
+                         comment.parse_comment(url, PAGE, section_only=False))
+
+        filing, documents = comment.parse_comment(url, PAGE)
+        self.assertEqual(filing['applicant'], u'Caf\xe9 Owners')
+        self.assertEqual(filing['filing_type'], 'COMMENT')
+        self.assertEqual([doc['fcc_num'] for doc in documents], ['7521094325'])
+        self.assertEqual(documents[0]['pagecount'], '12')
+
+    def test_unclosed_section(self):
+        self.assertEqual(comment.data_section('<div class="wwgrp"><span>open'), None)
+        self.assertEqual(comment.data_section('<html><body>no data</body></html>'), None)
+
+    def test_falls_back_to_page_when_section_loses_groups(self):
+        # a stray closing tag ends the section before the last group
+        page = PAGE.replace('<span>COMMENT</span>', '<span>COMMENT</span></div></div>')
+        url = 'http://apps.fcc.gov/ecfs/comment/view?id=6017456789'
+        self.assertEqual(comment.parse_comment(url, page, section_only=True),
+                         comment.parse_comment(url, page, section_only=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
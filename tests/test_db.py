@@ -0,0 +1,80 @@
+import unittest
+
+import psycopg2
+import psycopg2.extensions
+
+import db
+
+
+class Connection(object):
+
+    def __init__(self, status=psycopg2.extensions.STATUS_READY):
+        self.closed = 0
+        self.status = status
+
+    def get_transaction_status(self):
+        if self.closed:
+            return psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN
+        if self.status == psycopg2.extensions.STATUS_READY:
+            return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        return psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+
+    def cursor(self):
+        return Cursor()
+
+    def rollback(self):
+        pass
+
+
+class Cursor(object):
+
+    def execute(self, sql, args=None):
+        pass
+
+    def close(self):
+        pass
+
+
+class Pool(object):
+
+    def __init__(self):
+        self.connections = []
+        self.returned = []
+
+    def getconn(self):
+        conn = Connection()
+        self.connections.append(conn)
+        return conn
+
+    def putconn(self, conn, close=False):
+        self.returned.append((conn, close))
+
+
+class ConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = db.POOL
+        db.POOL = Pool()
+        db.LOCAL.connection = None
+
+    def tearDown(self):
+        db.POOL = self.saved
+        db.LOCAL.connection = None
+
+    def test_replaces_lost_idle_connection(self):
+        conn = db.connection()
+        conn.closed = 2
+        self.assertIsNot(db.connection(), conn)
+        self.assertEqual(db.POOL.returned, [(conn, True)])
+
+    def test_raises_for_lost_transaction(self):
+        conn = db.connection()
+        conn.status = psycopg2.extensions.STATUS_BEGIN
+        conn.closed = 2
+        self.assertRaises(db.CONNECTION_ERRORS, db.connection)
+        self.assertEqual(db.POOL.returned, [(conn, True)])
+        self.assertIsNot(db.connection(), conn)
+
+
+if __name__ == '__main__':
+    unittest.main()
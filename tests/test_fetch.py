@@ -0,0 +1,25 @@
+import unittest
+
+import fetch
+
+
+class FetchAllTest(unittest.TestCase):
+
+    def test_yields_every_url(self):
+        results = fetch.fetch_all(['a', 'b', 'c'], concurrency=2, getter=lambda url: url.upper())
+        self.assertEqual(sorted(results), [('a', 'A', None), ('b', 'B', None), ('c', 'C', None)])
+
+    def test_raises_error_of_url_producer(self):
+        def urls():
+            yield 'a'
+            raise ValueError("cannot parse search results")
+
+        results = []
+        with self.assertRaises(ValueError):
+            for item in fetch.fetch_all(urls(), concurrency=2, getter=lambda url: url.upper()):
+                results.append(item)
+        self.assertEqual(results, [('a', 'A', None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import os.path as path
+import shutil
+import tempfile
+import unittest
+
+import imagepack
+import localbackend
+
+
+class ImagePackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.images = {}
+        for number in (1, 2, 10):
+            filename = path.join(self.dir, 'page-%d.jpg' % (number,))
+            with open(filename, 'wb') as f:
+                f.write(('image %d ' % (number,)) * number)
+            self.images[number] = filename
+
+        self.pack = path.join(self.dir, 'pages.pack')
+        self.index = imagepack.pack(self.images, self.pack)
+
+        bucket = localbackend.StorageConnection(self.dir).get_bucket('images')
+        self.key = bucket.new_key('1234.pack')
+        self.key.set_contents_from_filename(self.pack)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def image(self, number):
+        with open(self.images[number], 'rb') as f:
+            return f.read()
+
+    def test_index_offsets(self):
+        with open(self.pack, 'rb') as f:
+            data = f.read()
+        self.assertEqual(imagepack.parse_header(data), self.index)
+        for number, offset, size in self.index:
+            self.assertEqual(data[offset:offset + size], self.image(number))
+
+    def test_incomplete_header(self):
+        with open(self.pack, 'rb') as f:
+            data = f.read(imagepack.PREFIX.size + 2)
+        self.assertEqual(imagepack.parse_header(data), None)
+
+    def test_read_page(self):
+        for number in self.images:
+            self.assertEqual(imagepack.read_page(self.key, number), self.image(number))
+        self.assertRaises(KeyError, imagepack.read_page, self.key, 3)
+
+    def test_read_index_beyond_first_fetch(self):
+        saved = imagepack.HEADER_FETCH_SIZE
+        imagepack.HEADER_FETCH_SIZE = imagepack.PREFIX.size + 4
+        try:
+            self.assertEqual(imagepack.read_index(self.key), self.index)
+        finally:
+            imagepack.HEADER_FETCH_SIZE = saved
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import base64
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import boto.exception
+
+import localbackend
+
+
+class QueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.conn = localbackend.QueueConnection(self.root)
+        self.queue = self.conn.get_queue('jobs')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, body):
+        self.queue.put(base64.b64encode(body))
+
+    def bodies(self, messages):
+        return [msg.get_body() for msg in messages]
+
+    def test_messages_come_in_order(self):
+        for body in ('a', 'b', 'c'):
+            self.write(body)
+        self.assertEqual(self.queue.count(), 3)
+        self.assertEqual(self.bodies(self.queue.get_messages(2)), ['a', 'b'])
+        self.assertEqual(self.bodies(self.queue.get_messages(2)), ['c'])
+        self.assertEqual(self.queue.get_messages(2), [])
+        self.assertEqual(self.queue.count(), 0)
+
+    def test_deleted_messages_are_not_redelivered(self):
+        self.write('a')
+        msg, = self.queue.get_messages(1, visibility_timeout=0)
+        self.conn.delete_message(self.queue, msg)
+        time.sleep(0.01)
+        self.assertEqual(self.queue.get_messages(1), [])
+
+    def test_expired_messages_are_redelivered(self):
+        self.write('a')
+        self.write('b')
+        first = self.queue.get_messages(1, visibility_timeout=0)
+        second = self.queue.get_messages(1, visibility_timeout=60)
+        self.assertEqual(self.bodies(first + second), ['a', 'b'])
+        time.sleep(0.01)
+        again = self.queue.get_messages(2)
+        self.assertEqual(self.bodies(again), ['a'])
+        self.assertNotEqual(again[0].receipt_handle, first[0].receipt_handle)
+
+        # the receipt of an earlier delivery no longer works
+        self.conn.delete_message(self.queue, first[0])
+        self.assertEqual(len(os.listdir(self.queue.inflight)), 2)
+
+    def test_change_visibility(self):
+        self.write('a')
+        msg, = self.queue.get_messages(1, visibility_timeout=0)
+        results = self.conn.change_message_visibility_batch(self.queue, [(msg, 60)])
+        self.assertEqual(results.errors, [])
+        time.sleep(0.01)
+        self.assertEqual(self.queue.get_messages(1), [])
+
+        self.conn.delete_message(self.queue, msg)
+        results = self.conn.change_message_visibility_batch(self.queue, [(msg, 60)])
+        self.assertEqual(len(results.errors), 1)
+
+    def test_concurrent_claimers(self):
+        count = 300
+        for i in range(count):
+            self.write(str(i))
+
+        received = []
+        errors = []
+
+        def claimer():
+            # a queue object of its own, as in a separate process
+            queue = localbackend.QueueConnection(self.root).get_queue('jobs')
+            try:
+                while True:
+                    messages = queue.get_messages(3, visibility_timeout=60)
+                    if not messages:
+                        break
+                    received.extend(self.bodies(messages))
+                    # make every claimer look for expired messages often
+                    queue.listed = []
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=claimer) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(received, key=int), [str(i) for i in range(count)])
+
+
+class BucketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.bucket = localbackend.StorageConnection(self.root).get_bucket('texts')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_contents_and_metadata(self):
+        key = self.bucket.new_key('12/34.txt')
+        key.set_metadata('format', 'compact')
+        key.set_contents_from_string('0123456789')
+
+        key = self.bucket.new_key('12/34.txt')
+        self.assertEqual(key.get_contents_as_string(), '0123456789')
+        self.assertEqual(key.get_metadata('format'), 'compact')
+        self.assertEqual(key.get_contents_as_string(headers={'Range': 'bytes=2-4'}), '234')
+        self.assertEqual(key.get_contents_as_string(headers={'Range': 'bytes=7-'}), '789')
+        self.assertEqual(self.bucket.get_key('12/34.txt').get_metadata('format'), 'compact')
+
+    def test_missing_key(self):
+        self.assertEqual(self.bucket.get_key('missing.txt'), None)
+        with self.assertRaises(boto.exception.S3ResponseError) as raised:
+            self.bucket.new_key('missing.txt').get_contents_as_string()
+        self.assertEqual(raised.exception.status, 404)
+
+    def test_list_and_delete(self):
+        for name in ('1.part-0.txt', '1.part-1.txt', '1.txt', '2.txt'):
+            self.bucket.new_key(name).set_contents_from_string(name)
+        self.assertEqual([key.name for key in self.bucket.list(prefix='1.part-')],
+                         ['1.part-0.txt', '1.part-1.txt'])
+        self.assertEqual([key.name for key in self.bucket.list(marker='1.txt')], ['2.txt'])
+        self.bucket.delete_keys(['1.part-0.txt', '1.part-1.txt'])
+        self.assertEqual([key.name for key in self.bucket.list()], ['1.txt', '2.txt'])
+
+    def test_rejects_names_outside_bucket(self):
+        self.assertRaises(ValueError, self.bucket.new_key('../escape').set_contents_from_string, 'x')
+
+
+if __name__ == '__main__':
+    unittest.main()
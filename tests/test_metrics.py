@@ -0,0 +1,42 @@
+import os.path as path
+import shutil
+import tempfile
+import unittest
+
+import metrics
+
+
+class RegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.saved = metrics.PROCESS
+        metrics.PROCESS = 'task-extract-0'
+
+    def tearDown(self):
+        metrics.PROCESS = self.saved
+        shutil.rmtree(self.dir)
+
+    def test_prometheus_file(self):
+        filename = path.join(self.dir, 'task-extract-0.prom')
+        registry = metrics.Registry(filename, 'prometheus', 3600)
+        registry.inc('extract_pages_total', 3)
+        registry.observe('extract_ocr_seconds', 0.2)
+        registry.write()
+
+        with open(filename) as f:
+            lines = f.read().splitlines()
+
+        self.assertIn('extract_pages_total{process="task-extract-0"} 3', lines)
+        self.assertIn('extract_ocr_seconds_bucket{process="task-extract-0",le="0.25"} 1', lines)
+        self.assertIn('extract_ocr_seconds_bucket{process="task-extract-0",le="+Inf"} 1', lines)
+        self.assertIn('extract_ocr_seconds_count{process="task-extract-0"} 1', lines)
+
+    def test_process_name(self):
+        self.assertEqual(metrics.process_name(), 'task-extract-0')
+        metrics.PROCESS = None
+        self.assertNotEqual(metrics.process_name(), 'task-extract-0')
+
+
+if __name__ == '__main__':
+    unittest.main()
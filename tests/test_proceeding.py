@@ -0,0 +1,32 @@
+import unittest
+
+import proceeding
+
+
+class KnownNumbersTest(unittest.TestCase):
+
+    def test_membership(self):
+        known = proceeding.KnownNumbers(['6017456789', '7521094325', '12', None, '', 'abc'])
+        self.assertEqual(len(known), 3)
+        self.assertIn('7521094325', known)
+        self.assertIn('12', known)
+        self.assertNotIn('7521094326', known)
+        self.assertNotIn('1', known)
+        self.assertNotIn('', known)
+        self.assertNotIn(None, known)
+        self.assertNotIn('abc', known)
+
+    def test_empty(self):
+        known = proceeding.KnownNumbers([])
+        self.assertEqual(len(known), 0)
+        self.assertNotIn('7521094325', known)
+
+    def test_new_comments(self):
+        known = proceeding.KnownNumbers(['7521094325'])
+        urls = ['http://apps.fcc.gov/ecfs/comment/view?id=7521094325',
+                'http://apps.fcc.gov/ecfs/comment/view?id=7521094326']
+        self.assertEqual(list(proceeding.new_comments(urls, known)), urls[1:])
+
+
+if __name__ == '__main__':
+    unittest.main()
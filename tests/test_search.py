@@ -0,0 +1,55 @@
+import time
+import unittest
+
+import search
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        cache = search.LRUCache(2, 60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_entries_expire(self):
+        cache = search.LRUCache(2, 60)
+        cache.put('a', 1)
+        cache.entries['a'] = (time.time() - 61, 1)
+        self.assertEqual(cache.get('a'), None)
+
+    def test_results_from_before_a_clear_are_not_stored(self):
+        cache = search.LRUCache(2, 60)
+        generation = cache.generation
+        cache.clear()
+        cache.put('a', 1, generation)
+        self.assertEqual(cache.get('a'), None)
+        cache.put('a', 1, cache.generation)
+        self.assertEqual(cache.get('a'), 1)
+
+
+class SnippetTest(unittest.TestCase):
+
+    def test_query_words(self):
+        self.assertEqual(search.query_words('"net neutrality" OR broadband -comcast'),
+                         ['net', 'neutrality', 'broadband'])
+
+    def test_snippet_around_match(self):
+        text = ' '.join(['filler'] * 100) + ' the regulations on broadband access ' + ' '.join(['more'] * 100)
+        result = search.snippet(text, ['regulation'], 60)
+        self.assertIn('regulations on broadband', result)
+        self.assertTrue(result.startswith('...'))
+        self.assertTrue(result.endswith('...'))
+        self.assertTrue(len(result) <= 66)
+
+    def test_snippet_without_match(self):
+        self.assertEqual(search.snippet('short page text', ['missing'], 60), 'short page text')
+        self.assertEqual(search.snippet(None, ['missing'], 60), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import os.path as path
+import json
+import shutil
+import tempfile
+import unittest
+
+import db
+import metrics
+import task
+
+
+class Cursor(object):
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, args=None):
+        self.conn.statements.append(sql)
+
+
+class Connection(object):
+    """Records the statements run through it"""
+
+    def __init__(self):
+        self.statements = []
+        self.commits = 0
+
+    def cursor(self):
+        return Cursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+
+class DocumentWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = Connection()
+        self.saved = (db.connection, task.update_document, metrics.REGISTRY)
+        db.connection = self.connection
+        self.lost = False
+        metrics.REGISTRY = False
+        self.failing = set()
+        task.update_document = self.update_document
+
+    def tearDown(self):
+        db.connection, task.update_document, metrics.REGISTRY = self.saved
+
+    def connection(self):
+        if self.lost:
+            self.lost = False
+            raise db.CONNECTION_ERRORS[0]("database connection lost during a transaction")
+        return self.conn
+
+    def update_document(self, data, content=None, commit=True, check_status=True):
+        if data['filing_doc_id'] in self.failing:
+            raise Exception("cannot write document")
+
+    def test_commit_returns_tokens_of_written_documents(self):
+        writer = task.DocumentWriter(batch_size=3, commit_interval=3600)
+        self.assertEqual(writer.write({'filing_doc_id': 1}, token='a'), [])
+        self.assertEqual(writer.write({'filing_doc_id': 2}, token='b'), [])
+        self.assertEqual(writer.write({'filing_doc_id': 3}, token='c'), ['a', 'b', 'c'])
+        self.assertEqual(self.conn.commits, 1)
+
+    def test_failed_write_keeps_its_token(self):
+        self.failing.add(2)
+        failures = []
+        writer = task.DocumentWriter(batch_size=2, commit_interval=3600, failed=failures.append)
+        self.assertEqual(writer.write({'filing_doc_id': 1}, token='a'), [])
+        self.assertEqual(writer.write({'filing_doc_id': 2}, token='b'), [])
+        self.assertIn("ROLLBACK TO SAVEPOINT document", self.conn.statements)
+        self.assertEqual(failures, ['b'])
+        self.assertEqual(writer.write({'filing_doc_id': 3}, token='c'), ['a', 'c'])
+        self.assertEqual(writer.commit(), [])
+
+    def test_lost_connection_drops_pending_tokens(self):
+        writer = task.DocumentWriter(batch_size=10, commit_interval=3600)
+        writer.write({'filing_doc_id': 1}, token='a')
+        self.lost = True
+        self.assertEqual(writer.commit(), [])
+        self.assertEqual(self.conn.commits, 0)
+        writer.write({'filing_doc_id': 2}, token='b')
+        self.assertEqual(writer.commit(), ['b'])
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = path.join(self.dir, 'state.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_marker_waits_for_earlier_pages(self):
+        checkpoint = task.Checkpoint(self.filename)
+        checkpoint.register('00', 0, '0010.txt', 1)
+        checkpoint.register('00', 1, '0020.txt', 1)
+        checkpoint.done('00', 1, '0015.txt')
+        self.assertEqual(checkpoint.marker('00'), '')
+        checkpoint.done('00', 0, '0005.txt')
+        self.assertEqual(checkpoint.marker('00'), '0020.txt')
+
+    def test_resume(self):
+        checkpoint = task.Checkpoint(self.filename)
+        checkpoint.register('00', 0, '0010.txt', 0)
+        checkpoint.register('00', 1, '0020.txt', 2)
+        checkpoint.done('00', 1, '0015.txt')
+        checkpoint.register('01', 0, '0110.txt', 0)
+        checkpoint.save()
+
+        resumed = task.Checkpoint(self.filename)
+        self.assertEqual(resumed.marker('00'), '0010.txt')
+        self.assertEqual(resumed.marker('01'), '0110.txt')
+        self.assertEqual(resumed.marker('02'), '')
+
+    def test_failed_keys_are_passed_and_kept(self):
+        checkpoint = task.Checkpoint(self.filename)
+        checkpoint.register('00', 0, '0010.txt', 2)
+        checkpoint.done('00', 0, '0005.txt')
+        checkpoint.fail('00', 0, '0007.txt')
+        self.assertEqual(checkpoint.marker('00'), '0010.txt')
+        checkpoint.save()
+
+        resumed = task.Checkpoint(self.filename)
+        self.assertEqual(resumed.failed, set(['0007.txt']))
+        resumed.done(None, None, '0007.txt')
+        self.assertEqual(resumed.failed, set())
+
+    def test_reads_markers_only_state(self):
+        with open(self.filename, 'w') as f:
+            json.dump({'0': '0999.txt'}, f)
+        checkpoint = task.Checkpoint(self.filename)
+        self.assertEqual(checkpoint.marker('0'), '0999.txt')
+        self.assertEqual(checkpoint.failed, set())
+
+
+if __name__ == '__main__':
+    unittest.main()
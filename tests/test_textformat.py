@@ -0,0 +1,26 @@
+import unittest
+
+import textformat
+
+
+class TextFormatTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        text = 'first page\fsecond page\f'
+        pages = [{'number': 1, 'offset': 0, 'size': 11}, {'number': 2, 'offset': 11, 'size': 12}]
+        self.assertEqual(textformat.decode(textformat.encode(pages, text)), (pages, text))
+
+    def test_round_trip_without_pages(self):
+        self.assertEqual(textformat.decode(textformat.encode([], '')), ([], ''))
+
+    def test_accepts_string_index_entries(self):
+        # legacy metadata holds the page index as strings
+        pages, text = textformat.decode(textformat.encode([{'number': '3', 'offset': '0', 'size': '4'}], 'text'))
+        self.assertEqual(pages, [{'number': 3, 'offset': 0, 'size': 4}])
+
+    def test_rejects_other_data(self):
+        self.assertRaises(ValueError, textformat.decode, 'plain text that is not compact')
+
+
+if __name__ == '__main__':
+    unittest.main()
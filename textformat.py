@@ -0,0 +1,68 @@
+#!/bin/env python
+
+"""
+textformat.py encodes extracted document text and its page index
+into a single compact object.
+
+Earlier versions stored the text as is and the page index as S3 user
+metadata, which overflows for large documents. The compact format is:
+
+  'FCCT'           magic
+  version          1 byte
+  page count       4 bytes, big endian
+  page index       page count entries of (number, offset, size),
+                   each a 4 byte big endian unsigned int
+  text             zlib compressed
+
+Offsets and sizes refer to the uncompressed text.
+
+Objects in this format are marked with format = compact in their metadata,
+which is what readers go by; the magic only guards decode against other data.
+
+usage:
+
+  import textformat
+
+  body = textformat.encode(pages, text)
+
+  pages, text = textformat.decode(body)
+
+"""
+
+import struct
+import zlib
+
+MAGIC = 'FCCT'
+VERSION = 1
+
+HEADER = struct.Struct('>4sBI')
+PAGE = struct.Struct('>III')
+
+def encode(pages, text, level=6):
+    """Returns the compact encoding of text and pages, a list of dicts
+       with number, offset and size entries"""
+
+    parts = [HEADER.pack(MAGIC, VERSION, len(pages))]
+    for page in pages:
+        parts.append(PAGE.pack(int(page['number']), int(page['offset']), int(page['size'])))
+    parts.append(zlib.compress(text, level))
+
+    return ''.join(parts)
+
+def decode(body):
+    """Returns the list of pages and the text encoded in body"""
+
+    magic, version, count = HEADER.unpack_from(body)
+    if magic != MAGIC:
+        raise ValueError("not a compact text object")
+    if version != VERSION:
+        raise ValueError("unsupported compact text version %d" % (version,))
+
+    pages = []
+    pos = HEADER.size
+    for i in range(count):
+        number, offset, size = PAGE.unpack_from(body, pos)
+        pages.append({'number': number, 'offset': offset, 'size': size})
+        pos += PAGE.size
+
+    return pages, zlib.decompress(body[pos:])
@@ -0,0 +1,186 @@
+#!/bin/env python
+
+"""
+tracing.py follows documents through inject, extract and collect.
+
+inject gives each task a trace, a small dict carried in the task message,
+the extraction result and the collector message. Each stage adds the time at
+which it passed the document:
+
+  enqueued          inject sent the task
+  dequeued          an extract worker received it
+  extract_start     the worker started on the document
+  extract_end       the pages were extracted
+  uploaded          the images and text were stored
+  collect_received  the collector received the result
+  committed         the pages were committed to the database
+
+The collector appends each completed trace to a JSON lines file, and the
+report shows percentiles of the time spent waiting in each queue and working
+in each stage. Times come from the clocks of the machines involved, which
+are assumed to be kept in sync.
+
+For split documents, the trace of the part that completes the document is
+the one recorded.
+
+Settings, in the [tracing] section of the config file:
+
+  enabled   whether inject starts traces (default yes)
+  file      where the collector records traces (default traces.jsonl
+            in the application directory), or none
+
+usage:
+
+  python tracing.py report [traces-file]
+
+"""
+
+import os.path as path
+import sys
+import json
+import time
+import uuid
+import threading
+
+from utils import *
+import dictconfig
+
+EVENTS = ('enqueued', 'dequeued', 'extract_start', 'extract_end', 'uploaded',
+          'collect_received', 'committed')
+
+# (name, from event, to event, kind) for the report
+STAGES = (
+    ('extract queue', 'enqueued', 'dequeued', 'wait'),
+    ('slot wait', 'dequeued', 'extract_start', 'wait'),
+    ('extraction', 'extract_start', 'extract_end', 'work'),
+    ('upload', 'extract_end', 'uploaded', 'work'),
+    ('collect queue', 'uploaded', 'collect_received', 'wait'),
+    ('database', 'collect_received', 'committed', 'work'),
+    ('total', 'enqueued', 'committed', None),
+    )
+
+PERCENTILES = (50, 90, 99)
+
+LOCK = threading.Lock()
+
+setting = dictconfig.section('tracing')
+
+def trace_file():
+    filename = setting('file', path.join(path.dirname(path.abspath(sys.argv[0])), 'traces.jsonl'))
+    if filename == 'none':
+        return None
+    return filename
+
+def start(data):
+    """Starts a trace in data, a task dict about to be enqueued"""
+    if setting('enabled', 'yes') == 'yes':
+        data['trace'] = {'id': uuid.uuid4().hex, 'enqueued': time.time()}
+
+def mark(data, event, when=None):
+    """Records the time of event in the trace of data, if it has one"""
+    trace = data.get('trace') if isinstance(data, dict) else None
+    if trace is not None:
+        trace[event] = time.time() if when is None else when
+
+def carry(source, target):
+    """Copies the trace of source, if any, into target"""
+    if isinstance(source, dict) and source.get('trace') is not None:
+        target['trace'] = dict(source['trace'])
+
+def record(documents, committed=None):
+    """Marks documents, a list of dicts, as committed and appends their traces
+       to the trace file"""
+    filename = trace_file()
+    if not filename:
+        return
+
+    if committed is None:
+        committed = time.time()
+
+    lines = []
+    for data in documents:
+        trace = data.get('trace')
+        if trace is None:
+            continue
+        trace['committed'] = committed
+        lines.append(json.dumps(dict(trace, filing_doc_id=data.get('filing_doc_id'),
+                                     fcc_num=data.get('fcc_num'), status=data.get('status'))) + '\n')
+
+    if not lines:
+        return
+
+    try:
+        with LOCK:
+            with open(filename, 'a') as f:
+                f.writelines(lines)
+    except IOError as e:
+        warn("tracing: cannot record traces", e)
+
+def percentile(values, p):
+    """Returns the pth percentile of values, a sorted list, by the nearest rank"""
+    if not values:
+        return None
+    rank = int(round(p / 100.0 * (len(values) - 1)))
+    return values[rank]
+
+def load(filename):
+    traces = []
+    with open(filename) as f:
+        for line in f:
+            try:
+                traces.append(json.loads(line))
+            except ValueError:
+                pass
+    return traces
+
+def stage_durations(traces):
+    """Returns a dict of stage name to sorted durations, in seconds,
+       for the traces that have both ends of the stage"""
+    durations = dict((name, []) for name, _, _, _ in STAGES)
+    for trace in traces:
+        for name, begin, end, kind in STAGES:
+            if trace.get(begin) is not None and trace.get(end) is not None:
+                durations[name].append(max(trace[end] - trace[begin], 0))
+    for values in durations.itervalues():
+        values.sort()
+    return durations
+
+def report(filename=None):
+    """Prints latency percentiles for each stage and the share of the
+       end to end time spent waiting in queues versus being worked on"""
+
+    filename = filename or trace_file()
+    traces = load(filename)
+    durations = stage_durations(traces)
+
+    print "%d traces in %s" % (len(traces), filename)
+    print
+    print "%-16s %8s %10s %10s %10s %10s %10s" % (('stage', 'count', 'mean') +
+                                                tuple('p%d' % (p,) for p in PERCENTILES) + ('max',))
+
+    for name, begin, end, kind in STAGES:
+        values = durations[name]
+        if not values:
+            print "%-16s %8d" % (name, 0)
+            continue
+        print "%-16s %8d %10.1f %10.1f %10.1f %10.1f %10.1f" % (
+            (name, len(values), sum(values) / len(values)) +
+            tuple(percentile(values, p) for p in PERCENTILES) + (values[-1],))
+
+    totals = {'wait': 0.0, 'work': 0.0}
+    for name, begin, end, kind in STAGES:
+        if kind:
+            totals[kind] += sum(durations[name])
+
+    overall = totals['wait'] + totals['work']
+    if overall:
+        print
+        print "time waiting in queues: %5.1f%%" % (100 * totals['wait'] / overall,)
+        print "time being processed:   %5.1f%%" % (100 * totals['work'] / overall,)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != 'report':
+        warn("usage: tracing.py report [traces-file]")
+        sys.exit(2)
+
+    report(*sys.argv[2:3])